@@ -0,0 +1,205 @@
+############################################################
+# Engine checks
+#
+# Runs each program in benchmarks/programs on every engine and checks
+# that the compiled closures print what the tree walker prints. Then
+# runs the short scripts in CASES, whose output is known, on every
+# engine.
+#
+# Each script runs in its own interpreter, as `final.py -q -k`, and what
+# it prints to stdout and stderr is compared.
+#
+# Usage: python benchmarks/check.py [-e tree|closure] [-v]
+#
+
+import argparse
+import difflib
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROGRAMS = os.path.join(HERE,"programs")
+FINAL = os.path.join(HERE,"..","final.py")
+
+ENGINES = ["tree","closure"]
+
+
+# (name, script, expected output)
+CASES = [
+
+    ("redefine class", """
+class ( A Object (a) () ( (get () print a;) (who () print "A";) ) )
+class ( B A (b) (b) ( (more () print b;) ) )
+obj A x = new B(1)
+procedure go () { (with x who ()) }
+go();
+class ( A Object (a) () ( (get () print (+ a 10);) (who () print "A2";) ) )
+go();
+(with x get ())
+obj B y = new B(2)
+(with y more ())
+(with y get ())
+""", """A
+A2
+11
+2
+12
+"""),
+
+    ("redefine fields", """
+class ( C Object (a b) () ( (show () { print a; print b; }) ) )
+obj C z = new C(3 4)
+class ( C Object (b c) () ( (show () { print b; print c; }) ) )
+(with z show ())
+""", """4
+none
+"""),
+
+    # B no longer fits A once A has two fields, so it keeps its old
+    # definition, p and all; a binding of x as an A must stop finding p,
+    # even from a call site that already found it
+    ("redefine with stale subclass", """
+class ( A Object (a) () ( (p () print "p";) ) )
+class ( B A (a) (a) ( (q () print "q";) ) )
+obj A x = new B(1)
+procedure go () { (with x p ()) }
+go();
+class ( A Object (a c) () ( (r () print "r";) ) )
+go();
+(with x p ())
+obj B y = new B(2)
+(with y q ())
+""", """p
+line 7: Exception: Runtime error: this function is not accessible or does not exist.
+line 8: Exception: Runtime error: this function is not accessible or does not exist.
+q
+"""),
+
+    ("method calling a method", """
+class ( A Object (x) () ( (m1 (n) print (+ n x);) (m2 (n) m1((* n 2));) (tw (n) { m1(n); m1(n); }) ) )
+class ( B A (y) (y) ( (m1 (n) print (- n y);) ) )
+obj A a = new A(1)
+(with a m2 (3))
+(with a tw (5))
+obj A b = new B(10)
+(with b m2 (3))
+""", """7
+6
+6
+-4
+"""),
+
+    ("counted for", """
+var i = 0;
+var s = 0;
+for i <- 0; (< i 10); i <- (+ i 1); s <- (+ s i);
+print s;
+print i;
+for i <- 5; (< i 3); i <- (+ i 1); print i;
+print i;
+procedure p (n) { var k = 0; var t = 0; for k <- 0; (< k n); k <- (+ k 2); t <- (+ t k); print t; print k; }
+p(10);
+p(0);
+""", """45
+10
+5
+20
+10
+0
+0
+"""),
+
+    ("for assigning its variable", """
+var i = 0;
+for i <- 0; (< i 10); i <- (+ i 3); { if (== i 3) i <- 7; else print i; }
+print i;
+""", """0
+10
+"""),
+
+    ("for assigning its limit", """
+var i = 0;
+var m = 4;
+for i <- 0; (< i m); i <- (+ i 1); m <- 2;
+print i;
+""", """2
+"""),
+
+    ("for with + rebound", """
+var i = 0;
+var + = (function (x y) (* x y));
+for i <- 1; (< i 100); i <- (+ i 2); print i;
+""", """1
+2
+4
+8
+16
+32
+64
+"""),
+
+    ("for over a non-number", """
+var i = 0;
+for i <- true; (< i 3); i <- (+ i 1); print i;
+""", """line 2: Exception: Runtime error: trying to compare non-numbers
+"""),
+]
+
+
+def run (engine,script):
+    # what final.py prints running the script on the engine
+    p = subprocess.Popen([sys.executable,"-u",FINAL,"-q","-k","-e",engine,"-"],
+                         stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    (out,err) = p.communicate(script)
+    return out
+
+
+def compare (name,expected,got,verbose):
+    # report whether got is what was expected
+    if got == expected:
+        print "ok      {}".format(name)
+        return True
+    print "FAILED  {}".format(name)
+    if verbose:
+        for line in difflib.unified_diff(expected.splitlines(),got.splitlines(),
+                                         "expected","got",lineterm=""):
+            print "    " + line
+    return False
+
+
+def main (argv):
+    parser = argparse.ArgumentParser(description="Check that the engines agree")
+    parser.add_argument("-e","--engine",action="append",choices=ENGINES,
+                        help="engine to check (default all)")
+    parser.add_argument("-v","--verbose",action="store_true",help="show what differs")
+    args = parser.parse_args(argv[1:])
+
+    engines = args.engine or ENGINES
+    failed = 0
+
+    for name in sorted(os.listdir(PROGRAMS)):
+        if not name.endswith(".imp"):
+            continue
+        with open(os.path.join(PROGRAMS,name)) as f:
+            script = f.read()
+        expected = run("tree",script)
+        for engine in engines:
+            if engine != "tree":
+                if not compare("{} ({})".format(name,engine),expected,run(engine,script),args.verbose):
+                    failed += 1
+
+    for (name,script,expected) in CASES:
+        for engine in engines:
+            if not compare("{} ({})".format(name,engine),expected,run(engine,script.lstrip("\n")),args.verbose):
+                failed += 1
+
+    if failed:
+        print "{} failed".format(failed)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
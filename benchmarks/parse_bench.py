@@ -0,0 +1,62 @@
+############################################################
+# Parser throughput benchmark
+#
+# Parses generated class definitions with deeply nested method bodies,
+# first with plain backtracking and then with packrat parsing enabled.
+#
+# Usage: python benchmarks/parse_bench.py [methods] [depth] [repeat]
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+
+import final
+
+
+def mkBody (depth):
+    # nested blocks and ifs; an if without an else is parsed twice at
+    # every level when backtracking, once by each of the if rules
+    if depth == 0:
+        return "x <- (+ x 1);"
+    return "{{ if (< x {0}) {1} while (> x {0}) x <- (- x 1); }}".format(depth,mkBody(depth-1))
+
+
+def mkClass (name,methods,depth):
+    funs = []
+    for i in range(methods):
+        funs.append("(m{} (x) {})".format(i,mkBody(depth)))
+        funs.append("(a{} (x) <>)".format(i))
+    return "absclass ( {} Object (x y) () ( {} ) )".format(name," ".join(funs))
+
+
+def bench (label,source,repeat):
+    start = time.time()
+    for i in range(repeat):
+        final.parse_imp(source)
+    elapsed = time.time() - start
+    print "{:<10} {:>8.3f}s  {:>10.0f} chars/s  {:>8.2f} classes/s".format(
+        label,elapsed,len(source)*repeat/elapsed,repeat/elapsed)
+
+
+def main (argv):
+    methods = int(argv[1]) if len(argv) > 1 else 20
+    depth = int(argv[2]) if len(argv) > 2 else 6
+    repeat = int(argv[3]) if len(argv) > 3 else 5
+
+    source = mkClass("Big",methods,depth)
+    print "class of {} methods, nesting depth {}, {} chars".format(methods*2,depth,len(source))
+
+    start = time.time()
+    final.grammar_imp()
+    print "{:<10} {:>8.3f}s".format("grammar",time.time() - start)
+
+    bench("plain",source,repeat)
+    final.packrat_imp()
+    bench("packrat",source,repeat)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,236 @@
+############################################################
+# Benchmark suite
+#
+# Runs the programs in benchmarks/programs, each in its own process so
+# that peak memory is measured per benchmark, and reports wall time,
+# ops/sec, peak memory and allocation counts.
+#
+# Each run parses the program afresh before the clock starts: the times
+# are for resolving and evaluating the forms in a fresh global
+# environment, the best of a few runs. Allocations are counted in a
+# separate, instrumented run so that the counting does not skew the
+# times.
+#
+# Results can be saved as JSON (-o) and compared with an earlier run
+# (-c), or the files themselves diffed.
+#
+# Usage: python benchmarks/run.py [-e tree|closure] [-O] [-r repeat]
+#                                 [-o results.json] [-c old.json] [name ...]
+#
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROGRAMS = os.path.join(HERE,"programs")
+
+sys.path.insert(0,os.path.join(HERE,".."))
+
+import final
+
+
+# (name, ops): the program is programs/<name>.imp, and ops is the number
+# of units of work it performs, used for ops/sec
+BENCHMARKS = [
+    ("recursion",242829),       # calls to fib and ack
+    ("loops",90300),            # loop iterations
+    ("strings",60000),          # concatenations of the running string
+    ("hierarchy",100000),       # with calls up a five-level hierarchy
+    ("instantiation",70000),    # new objects of a subclass
+    ("dispatch",45000),         # with calls through a superclass binding
+    ("arrays",300000),          # element reads and updates, elements mapped and sorted
+]
+
+# the classes whose instances are counted as allocations
+ALLOCATED = ["Env","RootEnv","VObject","VRefCell","VInteger","VBoolean",
+             "VString","VNone","VClosure","VProcedure","VArray",
+             "VObjectBinding"]
+
+
+class Output (object):
+    # collects what a benchmark prints
+
+    def __init__ (self):
+        self.chunks = []
+
+    def write (self,text):
+        self.chunks.append(text)
+
+    def flush (self):
+        pass
+
+    def getvalue (self):
+        return "".join(self.chunks)
+
+
+def load (name,optimize=False):
+    # the parsed forms of a benchmark program, optimized if asked
+    forms = []
+    with open(os.path.join(PROGRAMS,name+".imp")) as f:
+        for (lineno,result,error) in final.read_forms_imp(f):
+            if error is not None:
+                raise Exception("{}.imp line {}: {}".format(name,lineno,error))
+            if optimize:
+                final.optimize_imp(result)
+            forms.append(result)
+    return forms
+
+
+def execute (forms,run):
+    # run the forms in a fresh global environment, returning the output
+    env = final.global_env_imp()
+    out = Output()
+    saved = sys.stdout
+    sys.stdout = out
+    try:
+        for result in forms:
+            final.resolve_imp(result,env)
+            final.exec_imp(result,env,run)
+    finally:
+        sys.stdout = saved
+    return out.getvalue()
+
+
+def count_allocations (forms,run):
+    # run the forms once with the value and environment classes given a
+    # __new__ that counts their instances (some, like the strings
+    # concat makes, are made with __new__ alone, skipping __init__)
+    counts = {}
+
+    def counting (cls):
+        def __new__ (c,*args):
+            if c is cls:
+                counts[cls.__name__] = counts.get(cls.__name__,0) + 1
+            return object.__new__(c)
+        return staticmethod(__new__)
+
+    saved = {}
+    for name in ALLOCATED:
+        cls = getattr(final,name,None)
+        if cls is not None:
+            saved[cls] = cls.__dict__.get("__new__")
+            cls.__new__ = counting(cls)
+    try:
+        execute(forms,run)
+    finally:
+        for (cls,new) in saved.items():
+            if new is None:
+                del cls.__new__
+            else:
+                cls.__new__ = new
+    return counts
+
+
+def measure (name,ops,engine,repeat,optimize=False):
+    # the measurements of one benchmark, in this process
+    run = final.engine_imp(engine)
+    parses = []
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        forms = load(name,optimize)
+        parses.append(time.time() - start)
+        start = time.time()
+        output = execute(forms,run)
+        times.append(time.time() - start)
+    parse = min(parses)
+    wall = min(times)
+
+    allocations = count_allocations(load(name,optimize),run)
+
+    return {
+        "ops":ops,
+        "parse":round(parse,6),
+        "wall":round(wall,6),
+        "ops_per_sec":round(ops / wall,1) if wall > 0 else None,
+        "peak_kb":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "allocations":allocations,
+        "allocations_total":sum(allocations.values()),
+        "output":hashlib.md5(output).hexdigest(),
+    }
+
+
+def spawn (name,engine,repeat,optimize=False):
+    # measure a benchmark in a child process
+    text = subprocess.check_output([sys.executable,os.path.abspath(__file__),
+                                    "--child",name,"-e",engine,"-r",str(repeat)] +
+                                   (["-O"] if optimize else []))
+    return json.loads(text)
+
+
+def report (results,old=None):
+    print "{:<14} {:>9} {:>12} {:>10} {:>10}{}".format(
+        "benchmark","wall(s)","ops/sec","peak(KB)","allocs",
+        "   vs old" if old else "")
+    for (name,r) in sorted(results.items(),key=lambda item: order(item[0])):
+        line = "{:<14} {:>9.4f} {:>12.1f} {:>10} {:>10}".format(
+            name,r["wall"],r["ops_per_sec"],r["peak_kb"],r["allocations_total"])
+        if old and name in old:
+            o = old[name]
+            line += "   {:>6.2f}x".format(o["wall"] / r["wall"])
+            if o["output"] != r["output"]:
+                line += "  output differs"
+        print line
+
+
+def order (name):
+    names = [n for (n,ops) in BENCHMARKS]
+    return names.index(name) if name in names else len(names)
+
+
+def main (argv):
+    parser = argparse.ArgumentParser(description="Run the interpreter benchmarks")
+    parser.add_argument("names",nargs="*",help="benchmarks to run (default all)")
+    parser.add_argument("-e","--engine",default="tree",choices=["tree","closure"])
+    parser.add_argument("-r","--repeat",type=int,default=3,help="best of this many runs")
+    parser.add_argument("-O","--optimize",action="store_true",help="optimize the programs first")
+    parser.add_argument("-o","--output",help="save the results as JSON")
+    parser.add_argument("-c","--compare",help="compare with results saved earlier")
+    parser.add_argument("--child",help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    ops = dict(BENCHMARKS)
+
+    if args.child:
+        print json.dumps(measure(args.child,ops[args.child],args.engine,args.repeat,args.optimize))
+        return 0
+
+    names = args.names or [n for (n,o) in BENCHMARKS]
+    for name in names:
+        if name not in ops:
+            sys.stderr.write("unknown benchmark {}\n".format(name))
+            return 2
+
+    results = {}
+    for name in names:
+        results[name] = spawn(name,args.engine,args.repeat,args.optimize)
+
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)["benchmarks"]
+
+    print "engine {}{}, best of {}".format(args.engine," optimized" if args.optimize else "",args.repeat)
+    report(results,old)
+
+    if args.output:
+        with open(args.output,"w") as f:
+            json.dump({"engine":args.engine,
+                       "optimize":args.optimize,
+                       "repeat":args.repeat,
+                       "python":platform.python_version(),
+                       "benchmarks":results},f,indent=2,sort_keys=True,
+                      separators=(",",": "))
+            f.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -9,20 +9,298 @@
 #
 
 
+import bisect
+import copy
+import cPickle
+import gc
+import hashlib
+import json
+import os
+import re
+import stat
 import sys
+import threading
+import time
+import weakref
+from array import array
+from thread import get_ident
+
+#
+# Environments
+#
+
+class Env (object):
+    # A frame of bindings: an array of values addressed by slot number,
+    # linked to the frame of the enclosing scope
+
+    __slots__ = ("slots","parent")
+
+    def __init__ (self,slots,parent):
+        self.slots = slots
+        self.parent = parent
+
+
+class RootEnv (Env):
+    # A frame at the root of a scope chain (the global environment, or the
+    # environment of a class) whose slots can also be found by name.
+    # A name gets a slot the first time it is seen, so that identifiers can
+    # be resolved before the name is defined (eg, recursive functions)
+
+    __slots__ = ("names",)
+
+    def __init__ (self,names=None,slots=None):
+        Env.__init__(self,[] if slots is None else slots,None)
+        self.names = {} if names is None else names
+
+    def slot (self,name):
+        if name not in self.names:
+            self.names[name] = len(self.slots)
+            self.slots.append(None)
+        return self.names[name]
+
+    def define (self,name,v):
+        self.slots[self.slot(name)] = v
+
+    def lookup (self,name):
+        if name in self.names and self.slots[self.names[name]] is not None:
+            return self.slots[self.names[name]]
+        raise Exception("Runtime error: unknown identifier {}".format(name))
+
+    def resolve (self,name):
+        return (0,self.slot(name))
+
+    def copy (self):
+        return RootEnv(dict(self.names),self.slots[:])
+
+
+class Scope (object):
+    # Compile-time picture of a frame, used by the resolver to turn
+    # identifiers into (depth,slot) addresses
+
+    def __init__ (self,names,parent):
+        self.names = {}
+        for (i,name) in enumerate(names):
+            # the first binding of a name shadows any later one
+            if name not in self.names:
+                self.names[name] = i
+        self.parent = parent
+
+    def resolve (self,name):
+        if name in self.names:
+            return (0,self.names[name])
+        if self.parent is None:
+            return (None,None)
+        (depth,slot) = self.parent.resolve(name)
+        if depth is None:
+            return (None,None)
+        return (depth+1,slot)
+
 
 #
 # Expressions
 #
+# Besides eval, every expression can compile itself once into a Python
+# closure taking the environment, which does the same work without going
+# through the expression's attributes and methods each time
+
+#
+# Calls in tail position (the last thing a function, procedure or method
+# body does) are not made where they occur: evalTail and compileTail
+# return a TailCall for them instead, and the call that ran the body
+# makes it, in a loop (see ECall.eval), so that tail recursion runs in
+# constant stack
 
 class Exp (object):
-    pass
+
+    def evalTail (self,env):
+        # the value of the expression, or a TailCall to make to get it
+        return self.eval(env)
+
+    def compile (self):
+        return self.eval
+
+    def compileTail (self):
+        # the closure for evalTail
+        return self.compile()
+
+    def optimize (self):
+        # the expression to use instead of this one (see optimize_imp)
+        return self
+
+    def unbox (self,scope):
+        # the expression to use instead of this one (see assignedNames)
+        mapSubexps(self,lambda e: e.unbox(scope))
+        return self
+
+    def __getstate__ (self):
+        # compiled closures are left out of images (see save_image_imp),
+        # and made again when first needed
+        state = dict(self.__dict__)
+        state.pop("_closure",None)
+        return state
+
+
+class TailCall (object):
+    # a body to evaluate (with evalTail) in a new frame, in place of the
+    # call that returned this
+
+    __slots__ = ("body","env")
+
+    def __init__ (self,body,env):
+        self.body = body
+        self.env = env
+
+
+def callBody (body,env):
+    # evaluate a body in the frame made for it by a call, along with the
+    # calls it makes in tail position
+    if STOPS:
+        stopped()
+    r = body.evalTail(env)
+    while type(r) is TailCall:
+        if STOPS:
+            stopped()
+        r = r.body.evalTail(r.env)
+    return r
+
+
+def compiled (body):
+    # the closure for a function, procedure or method body, compiled the
+    # first time it is called (resolving the body again drops it); it may
+    # return a TailCall
+    f = getattr(body,"_closure",None)
+    if f is None:
+        f = body.compileTail()
+        body._closure = f
+    return f
+
+
+def callCompiled (body,env):
+    # callBody, with compiled bodies
+    if STOPS:
+        stopped()
+    r = compiled(body)(env)
+    while type(r) is TailCall:
+        if STOPS:
+            stopped()
+        r = compiled(r.body)(r.env)
+    return r
+
+
+def subexps (exp):
+    # the expressions exp is immediately made of, found in its attributes
+    found = []
+    def collect (v):
+        if isinstance(v,(Exp,ETemplate,EWith)):
+            found.append(v)
+        elif isinstance(v,(list,tuple,ParseResults)):
+            for x in v:
+                collect(x)
+    for v in vars(exp).values():
+        collect(v)
+    return found
+
+
+def subexpsDeep (exp):
+    # exp and every expression under it
+    pending = [exp]
+    while pending:
+        e = pending.pop()
+        yield e
+        pending.extend(subexps(e))
+
+
+def countNodes (exp):
+    # the size of an expression; a folded constant counts as the
+    # expression it was folded from, which it keeps (see EConstant)
+    count = 0
+    pending = [exp]
+    while pending:
+        e = pending.pop()
+        if type(e) is EConstant:
+            pending.append(e._exp)
+            continue
+        count += 1
+        pending.extend(subexps(e))
+    return count
+
+
+def countFolds (exp):
+    # the number of folded constants in an expression, not counting
+    # those folded into others
+    count = 0
+    pending = [exp]
+    while pending:
+        e = pending.pop()
+        if type(e) is EConstant:
+            count += 1
+        else:
+            pending.extend(subexps(e))
+    return count
+
+
+def mapSubexps (exp,f):
+    # replace each expression exp is immediately made of with f of it
+    def rebuild (v):
+        if isinstance(v,(Exp,ETemplate,EWith)):
+            return f(v)
+        if isinstance(v,tuple):
+            return tuple([ rebuild(x) for x in v ])
+        if isinstance(v,(list,ParseResults)):
+            return [ rebuild(x) for x in v ]
+        return v
+    for (name,v) in vars(exp).items():
+        setattr(exp,name,rebuild(v))
+
+
+#
+# Unboxing
+#
+# Every parameter and var gets a ref cell (see mkFunBody and mkBlock)
+# and every identifier reads through one, but only the variables that
+# are updated need them. The unbox methods bind the others to their
+# values directly and read them without oper_deref. They work on parsed
+# forms, before they are resolved, and take a scope mapping the names
+# bound around the expression to whether they are unboxed. The fields
+# of an object are held in its frame unboxed, and mapped to FIELD
+
+FIELD = "field"
+
+def assignedNames (exp,names):
+    # the names among names that exp updates (with <- or name[...] <-),
+    # when not bound again in between
+    found = set()
+    pending = [(exp,frozenset(names))]
+    while pending:
+        (e,live) = pending.pop()
+        if not live:
+            continue
+        if type(e) is EPrimCall and e._prim in (oper_update,oper_update_arr) and type(e._exps[0]) is EId and e._exps[0]._id in live:
+            found.add(e._exps[0]._id)
+        if type(e) is ELet:
+            pending.extend([ (b,live) for (id,b) in e._bindings ])
+            pending.append((e._e2,live - set([ id for (id,b) in e._bindings ])))
+        elif type(e) in (EFunction,EProcedure):
+            pending.append((e._body,live - set(e._params)))
+        else:
+            pending.extend([ (sub,live) for sub in subexps(e) ])
+    return found
+
+
+def harmless (exp):
+    # can working out the value of exp neither fail nor do anything else?
+    if type(exp) is ERefCell:
+        return harmless(exp._initial)
+    return type(exp) in (EValue,EFunction,EProcedure)
 
 
 class EValue (Exp):
     # Value literal (could presumably replace EInteger and EBoolean)
     def __init__ (self,v):
         self._value = v
+
+    def unbox (self,scope):
+        return self
     
     def __str__ (self):
         return "EValue({})".format(self._value)
@@ -30,6 +308,13 @@ class EValue (Exp):
     def eval (self,env):
         return self._value
 
+    def resolve (self,scope):
+        pass
+
+    def compile (self):
+        v = self._value
+        return lambda env: v
+
     
 class EPrimCall (Exp):
     # Call an underlying Python primitive, passing in Values
@@ -48,12 +333,47 @@ class EPrimCall (Exp):
         vs = [ e.eval(env) for e in self._exps ]
         return apply(self._prim,vs)
 
+    def resolve (self,scope):
+        for e in self._exps:
+            e.resolve(scope)
+
+    def optimize (self):
+        self._exps = [ e.optimize() for e in self._exps ]
+        return self
+
+    def unbox (self,scope):
+        # a field (FIELD in scope) is read, updated and has its elements
+        # updated in its object's frame directly
+        e = self._exps[0] if self._exps else None
+        held = scope.get(e._id) if type(e) is EId else None
+        if self._prim is oper_deref and len(self._exps) == 1 and held:
+            return EField(e._id) if held is FIELD else e
+        if held is FIELD and self._prim is oper_update:
+            return EStore(EField(e._id),self._exps[1].unbox(scope))
+        if held is FIELD and self._prim is oper_update_arr:
+            (value,index) = (self._exps[1].unbox(scope),self._exps[2].unbox(scope))
+            return EPrimCall(oper_update_elt,[EField(e._id),value,index])
+        self._exps = [ e.unbox(scope) for e in self._exps ]
+        return self
+
+    def compile (self):
+        prim = self._prim
+        if prim is oper_deref and len(self._exps) == 1 and type(self._exps[0]) is EId:
+            return self._exps[0].compileDeref()
+        fs = [ e.compile() for e in self._exps ]
+        if len(fs) == 1:
+            (f1,) = fs
+            return lambda env: prim(f1(env))
+        if len(fs) == 2:
+            (f1,f2) = fs
+            return lambda env: prim(f1(env),f2(env))
+        return lambda env: prim(*[ f(env) for f in fs ])
+
 
 class EIf (Exp):
     # Conditional expression
 
     def __init__ (self,e1,e2,e3):
-        print e1
         self._cond = e1
         self._then = e2
         self._else = e3
@@ -62,13 +382,56 @@ class EIf (Exp):
         return "EIf({},{},{})".format(self._cond,self._then,self._else)
 
     def eval (self,env):
+        return self.branch(env).eval(env)
+
+    def evalTail (self,env):
+        return self.branch(env).evalTail(env)
+
+    def branch (self,env):
         v = self._cond.eval(env)
+        if v is TRUE:
+            return self._then
+        if v is FALSE:
+            return self._else
         if v.type != "boolean":
             raise Exception ("Runtime error: condition not a Boolean")
         if v.value:
-            return self._then.eval(env)
+            return self._then
         else:
-            return self._else.eval(env)
+            return self._else
+
+    def resolve (self,scope):
+        self._cond.resolve(scope)
+        self._then.resolve(scope)
+        self._else.resolve(scope)
+
+    def optimize (self):
+        # an if on a literal condition is just one of its branches
+        self._cond = self._cond.optimize()
+        if type(self._cond) is EValue and self._cond._value.type == "boolean":
+            return (self._then if self._cond._value.value else self._else).optimize()
+        self._then = self._then.optimize()
+        self._else = self._else.optimize()
+        return self
+
+    def compile (self):
+        return self.compileBranches(self._then.compile(),self._else.compile())
+
+    def compileTail (self):
+        return self.compileBranches(self._then.compileTail(),self._else.compileTail())
+
+    def compileBranches (self,then,els):
+        # TRUE and FALSE are the only Booleans (see mkBoolean), so
+        # anything else is not one
+        cond = self._cond.compile()
+        def f (env):
+            v = cond(env)
+            if v is TRUE:
+                return then(env)
+            if v is FALSE:
+                return els(env)
+            raise Exception ("Runtime error: condition not a Boolean")
+        return f
 
 
 class ELet (Exp):
@@ -84,44 +447,295 @@ class ELet (Exp):
         return "ELet([{}],{})".format(",".join([ "({},{})".format(id,str(exp)) for (id,exp) in self._bindings ]),self._e2)
 
     def eval (self,env):
-        new_env = [ (id,e.eval(env)) for (id,e) in self._bindings] + env
+        new_env = Env([ e.eval(env) for (id,e) in self._bindings],env)
         return self._e2.eval(new_env)
 
+    def evalTail (self,env):
+        new_env = Env([ e.eval(env) for (id,e) in self._bindings],env)
+        return self._e2.evalTail(new_env)
+
+    def resolve (self,scope):
+        for (id,e) in self._bindings:
+            e.resolve(scope)
+        self._e2.resolve(Scope([ id for (id,e) in self._bindings],scope))
+
+    def optimize (self):
+        # drop the bindings the body never refers to, when working out
+        # their value cannot fail; a let left without bindings is its body
+        body = self._e2.optimize()
+        used = set( e._id for e in subexpsDeep(body) if type(e) is EId )
+        bindings = []
+        for (id,e) in self._bindings:
+            e = e.optimize()
+            if id in used or not harmless(e):
+                bindings.append((id,e))
+        if not bindings:
+            return body
+        self._bindings = bindings
+        self._e2 = body
+        return self
+
+    def unbox (self,scope):
+        # a binding to a ref cell its body never updates is bound to the
+        # cell's initial value instead
+        ids = [ id for (id,e) in self._bindings ]
+        assigned = assignedNames(self._e2,ids)
+        inner = dict(scope)
+        bindings = []
+        for (id,e) in self._bindings:
+            e = e.unbox(scope)
+            inner[id] = type(e) is ERefCell and id not in assigned and ids.count(id) == 1
+            if inner[id]:
+                e = e._initial
+            bindings.append((id,e))
+        body = self._e2.unbox(inner)
+        if bindings and all(type(e) is EId and e._id == id for (id,e) in bindings):
+            # only passes on the parameters of a function, as they are
+            return body
+        self._bindings = bindings
+        self._e2 = body
+        return self
+
+    def compile (self):
+        return self.compileBody(self._e2.compile())
+
+    def compileTail (self):
+        return self.compileBody(self._e2.compileTail())
+
+    def compileBody (self,body):
+        n = len(self._bindings)
+        # the bindings a function body starts with (see mkFunBody)
+        if n > 0 and all(type(e) is ERefCell and type(e._initial) is EId and
+                         e._initial._depth == 0 and e._initial._slot == i
+                         for (i,(id,e)) in enumerate(self._bindings)):
+            return lambda env: body(Env([ VRefCell(v) for v in env.slots[:n] ],env))
+        fs = [ e.compile() for (id,e) in self._bindings ]
+        return lambda env: body(Env([ f(env) for f in fs ],env))
+
 class EId (Exp):
     # identifier
+    # resolve() fills in the lexical address of the binding: how many
+    # frames up the chain it lives, and its slot in that frame
 
     def __init__ (self,id):
         self._id = id
+        self._depth = None
+        self._slot = None
 
     def __str__ (self):
         return "EId({})".format(self._id)
 
     def eval (self,env):
-        for (id,v) in env:
-            if self._id == id:
-                return v
-        raise Exception("Runtime error: unknown identifier {}".format(self._id))
+        depth = self._depth
+        if depth is None:
+            raise Exception("Runtime error: unknown identifier {}".format(self._id))
+        while depth:
+            env = env.parent
+            depth -= 1
+        v = env.slots[self._slot]
+        if v is None:
+            raise Exception("Runtime error: unknown identifier {}".format(self._id))
+        return v
+
+    def resolve (self,scope):
+        (self._depth,self._slot) = scope.resolve(self._id)
+
+    def unbox (self,scope):
+        return self
+
+    def compile (self):
+        (id,depth,slot) = (self._id,self._depth,self._slot)
+        if depth is None:
+            return self.eval
+        def f (env):
+            for i in xrange(depth):
+                env = env.parent
+            v = env.slots[slot]
+            if v is None:
+                raise Exception("Runtime error: unknown identifier {}".format(id))
+            return v
+        def f0 (env):
+            v = env.slots[slot]
+            if v is None:
+                raise Exception("Runtime error: unknown identifier {}".format(id))
+            return v
+        return f0 if depth == 0 else f
+
+    def compileDeref (self):
+        # the closure for oper_deref applied to this identifier
+        get = self.compile()
+        def f (env):
+            v = get(env)
+            if v.type != "ref":
+                raise Exception ("Runtime error: dereferencing a non-reference value")
+            return v.content
+        return f
+
+
+class EField (EId):
+    # An object's field, held in the object's frame itself rather than in
+    # a ref cell (see ETemplate.build). Unlike an unboxed variable it can
+    # be updated, by EStore
+
+    def __str__ (self):
+        return "EField({})".format(self._id)
+
+
+def primitiveOf (body):
+    # the primitive a function body applies to the function's parameters,
+    # in order, if that is all it does (like + in the initial environment)
+    if type(body) is EPrimCall and [ (e._depth,e._slot) if type(e) is EId else None for e in body._exps ] == [ (0,i) for i in range(len(body._exps)) ]:
+        return body._prim
+    return None
+
+
+def calleeName (fun):
+    # the identifier a function expression dereferences, if it is one
+    if type(fun) is EPrimCall and fun._prim is oper_deref and len(fun._exps) == 1:
+        fun = fun._exps[0]
+    if type(fun) is EId:
+        return fun._id
+    return None
+
+
+def builtinHolds (builtin,env):
+    # does the primitive call noted by builtinOf still hold in env?
+    (depth,slot,cell,closure,prim) = builtin
+    while depth:
+        env = env.parent
+        depth -= 1
+    return env.slots[slot] is cell and cell.content is closure
+
+
+def builtinOf (fun,n,scope):
+    # For a call of fun with n arguments: if fun is an identifier bound,
+    # when it is resolved in scope, to a function that only applies a
+    # primitive, return (depth,slot,cell,closure,primitive), where cell is
+    # the ref cell found at (depth,slot) and closure what it holds.
+    # The call can apply the primitive directly for as long as that slot
+    # holds that cell and that closure
+    if not (type(fun) is EPrimCall and fun._prim is oper_deref and len(fun._exps) == 1 and type(fun._exps[0]) is EId):
+        return None
+    (depth,slot) = (fun._exps[0]._depth,fun._exps[0]._slot)
+    if depth is None:
+        return None
+    frame = scope
+    for i in range(depth):
+        frame = frame.parent
+    if not isinstance(frame,Env):
+        # a local binding, which only exists at run time
+        return None
+    cell = frame.slots[slot]
+    if cell is None or cell.type != "ref" or cell.content is None or cell.content.type != "function":
+        return None
+    closure = cell.content
+    prim = primitiveOf(closure.body)
+    if prim is None or len(closure.params) != n:
+        return None
+    return (depth,slot,cell,closure,prim)
 
 
 class ECall (Exp):
     # Call a defined function in the function dictionary
+    # resolve() notes when the function is a primitive of the initial
+    # environment (see builtinOf), which is then applied directly
 
     def __init__ (self,fun,exps):
         self._fun = fun
         self._args = exps
+        self._builtin = None
 
     def __str__ (self):
         return "ECall({},[{}])".format(str(self._fun),",".join(str(e) for e in self._args))
 
     def eval (self,env):
+        builtin = self._builtin
+        if builtin is not None and builtinHolds(builtin,env):
+            return builtin[4](*[ e.eval(env) for e in self._args ])
+        (f,args) = self.function(env)
+        return callBody(f.body,Env(args,f.env))
+
+    def evalTail (self,env):
+        builtin = self._builtin
+        if builtin is not None and builtinHolds(builtin,env):
+            return builtin[4](*[ e.eval(env) for e in self._args ])
+        (f,args) = self.function(env)
+        return TailCall(f.body,Env(args,f.env))
+
+    def function (self,env):
+        # the function called and the arguments to call it with
         f = self._fun.eval(env)
         if f.type != "function":
             raise Exception("Runtime error: trying to call a non-function")
         args = [ e.eval(env) for e in self._args]
         if len(args) != len(f.params):
             raise Exception("Runtime error: argument # mismatch in call")
-        new_env = zip(f.params,args) + f.env
-        return f.body.eval(new_env)
+        return (f,args)
+
+    def resolve (self,scope):
+        self._fun.resolve(scope)
+        for e in self._args:
+            e.resolve(scope)
+        self._builtin = builtinOf(self._fun,len(self._args),scope)
+
+    def optimize (self):
+        # a built-in applied to constants is folded into an EConstant,
+        # which checks when run that the built-in has not been rebound
+        self._fun = self._fun.optimize()
+        self._args = [ e.optimize() for e in self._args ]
+        prim = FOLDABLE_PRIMS.get(calleeName(self._fun))
+        if prim is None or not all(type(e) is EValue or type(e) is EConstant for e in self._args):
+            return self
+        try:
+            v = prim(*[ e._value for e in self._args ])
+        except Exception:
+            return self
+        calls = [(self,prim)]
+        for e in self._args:
+            if type(e) is EConstant:
+                calls.extend(e._calls)
+        return EConstant(v,calls,self)
+
+    def unbox (self,scope):
+        self._fun = self._fun.unbox(scope)
+        self._args = [ e.unbox(scope) for e in self._args ]
+        return self
+
+    def compile (self):
+        return self.compileCall(False)
+
+    def compileTail (self):
+        return self.compileCall(True)
+
+    def compileCall (self,tail):
+        fun = self._fun.compile()
+        fs = [ e.compile() for e in self._args ]
+        def call (env):
+            f = fun(env)
+            if f.type != "function":
+                raise Exception("Runtime error: trying to call a non-function")
+            args = [ g(env) for g in fs ]
+            if len(args) != len(f.params):
+                raise Exception("Runtime error: argument # mismatch in call")
+            if tail:
+                return TailCall(f.body,Env(args,f.env))
+            return callCompiled(f.body,Env(args,f.env))
+        if self._builtin is None:
+            return call
+        (depth,slot,cell,closure,prim) = self._builtin
+        def frame (env):
+            for i in xrange(depth):
+                env = env.parent
+            return env
+        if len(fs) == 2:
+            (f1,f2) = fs
+            if depth == 0:
+                return lambda env: prim(f1(env),f2(env)) if env.slots[slot] is cell and cell.content is closure else call(env)
+            return lambda env: prim(f1(env),f2(env)) if frame(env).slots[slot] is cell and cell.content is closure else call(env)
+        if len(fs) == 1:
+            (f1,) = fs
+            return lambda env: prim(f1(env)) if frame(env).slots[slot] is cell and cell.content is closure else call(env)
+        return lambda env: prim(*[ g(env) for g in fs ]) if frame(env).slots[slot] is cell and cell.content is closure else call(env)
 
 class EProcCall (Exp):
     # Call a defined function in the function dictionary
@@ -134,17 +748,116 @@ class EProcCall (Exp):
         return "EProcCall({},[{}])".format(str(self._fun),",".join(str(e) for e in self._args))
 
     def eval (self,env):
+        (f,frame) = self.procedure(env)
+        callBody(f.body,frame)
+        return NONE
+
+    def evalTail (self,env):
+        # whoever called the body this is the tail of drops its value
+        (f,frame) = self.procedure(env)
+        return TailCall(f.body,frame)
+
+    def procedure (self,env):
+        # the procedure called and the frame to run its body in
         f = self._fun.eval(env)
         if f.type != "procedure":
             raise Exception("Runtime error: trying to call a non-function")
+        parent = f.env if f.env is not None else methodFrame(env)
         args = [ e.eval(env) for e in self._args]
         if len(args) != len(f.params):
             raise Exception("Runtime error: argument # mismatch in call")
-        new_env = zip(f.params,args) + f.env
-        f.body.eval(new_env)
-        return VNone()
+        return (f,Env(args,parent))
+
+    def resolve (self,scope):
+        self._fun.resolve(scope)
+        for e in self._args:
+            e.resolve(scope)
+
+    def optimize (self):
+        self._fun = self._fun.optimize()
+        self._args = [ e.optimize() for e in self._args ]
+        return self
+
+    def unbox (self,scope):
+        self._fun = self._fun.unbox(scope)
+        self._args = [ e.unbox(scope) for e in self._args ]
+        return self
+
+    def compile (self):
+        return self.compileCall(False)
+
+    def compileTail (self):
+        return self.compileCall(True)
+
+    def compileCall (self,tail):
+        fun = self._fun.compile()
+        fs = [ e.compile() for e in self._args ]
+        def call (env):
+            f = fun(env)
+            if f.type != "procedure":
+                raise Exception("Runtime error: trying to call a non-function")
+            parent = f.env if f.env is not None else methodFrame(env)
+            args = [ g(env) for g in fs ]
+            if len(args) != len(f.params):
+                raise Exception("Runtime error: argument # mismatch in call")
+            if tail:
+                return TailCall(f.body,Env(args,parent))
+            callCompiled(f.body,Env(args,parent))
+            return NONE
+        return call
+
+
+def methodFrame (env):
+    # A method has no environment of its own: it runs in the frame of the
+    # object it is called on. Called by name from another method, as a
+    # procedure, it runs on the same object as the caller, whose frame
+    # is the first object frame up env's chain. Since the name was found
+    # in the class environment of that object, an override in a subclass
+    # is the one called, as with `with`
+    while env is not None:
+        if isinstance(env,VObject):
+            return env
+        env = env.parent
+    raise Exception("Runtime error: methods must be called using with")
+
+
+
+
+class EConstant (Exp):
+    # The value of built-in primitives applied to constants, worked out
+    # by the optimizer. It stands for the expression it was folded from,
+    # which is kept to be used instead if any of the calls folded, in
+    # _calls with the primitive they were folded with, turns out not to
+    # apply that primitive (a local binding, or a built-in rebound)
+
+    def __init__ (self,v,calls,exp):
+        self._value = v
+        self._calls = calls
+        self._exp = exp
+
+    def __str__ (self):
+        return "EConstant({},{})".format(self._value,self._exp)
+
+    def holds (self,env):
+        for (call,prim) in self._calls:
+            builtin = call._builtin
+            if builtin is None or builtin[4] is not prim or not builtinHolds(builtin,env):
+                return False
+        return True
 
+    def eval (self,env):
+        if self.holds(env):
+            return self._value
+        return self._exp.eval(env)
+
+    def resolve (self,scope):
+        self._exp.resolve(scope)
 
+    def compile (self):
+        v = self._value
+        exp = self._exp.compile()
+        holds = self.holds
+        return lambda env: v if holds(env) else exp(env)
 
 
 class EFunction (Exp):
@@ -160,6 +873,27 @@ class EFunction (Exp):
     def eval (self,env):
         return VClosure(self._params,self._body,env)
 
+    def resolve (self,scope):
+        self._body.resolve(Scope(self._params,scope))
+        # drop the body's compiled form (see compiled), it may be stale
+        self._body._closure = None
+
+    def optimize (self):
+        self._body = self._body.optimize()
+        return self
+
+    def unbox (self,scope):
+        # the parameters hide the names bound outside
+        inner = dict(scope)
+        for p in self._params:
+            inner[p] = False
+        self._body = self._body.unbox(inner)
+        return self
+
+    def compile (self):
+        (params,body) = (self._params,self._body)
+        return lambda env: VClosure(params,body,env)
+
 
 class ERefCell (Exp):
     # this could (should) be turned into a primitive
@@ -175,6 +909,51 @@ class ERefCell (Exp):
         v = self._initial.eval(env)
         return VRefCell(v)
 
+    def resolve (self,scope):
+        self._initial.resolve(scope)
+
+    def optimize (self):
+        self._initial = self._initial.optimize()
+        return self
+
+    def compile (self):
+        initial = self._initial.compile()
+        return lambda env: VRefCell(initial(env))
+
+class EStore (Exp):
+    # Assignment to an object's field, in the object's frame
+
+    def __init__ (self,field,exp):
+        self._field = field
+        self._exp = exp
+
+    def __str__ (self):
+        return "EStore({},{})".format(str(self._field),str(self._exp))
+
+    def eval (self,env):
+        v = self._exp.eval(env)
+        depth = self._field._depth
+        while depth:
+            env = env.parent
+            depth -= 1
+        env.slots[self._field._slot] = v
+        return NONE
+
+    def resolve (self,scope):
+        self._field.resolve(scope)
+        self._exp.resolve(scope)
+
+    def compile (self):
+        (depth,slot) = (self._field._depth,self._field._slot)
+        exp = self._exp.compile()
+        def f (env):
+            v = exp(env)
+            for i in xrange(depth):
+                env = env.parent
+            env.slots[slot] = v
+            return NONE
+        return f
+
 class EDo (Exp):
 
     def __init__ (self,exps):
@@ -185,11 +964,57 @@ class EDo (Exp):
 
     def eval (self,env):
         # default return value for do when no arguments
-        v = VNone()
+        v = NONE
         for e in self._exps:
             v = e.eval(env)
         return v
 
+    def evalTail (self,env):
+        if not self._exps:
+            return NONE
+        for e in self._exps[:-1]:
+            e.eval(env)
+        return self._exps[-1].evalTail(env)
+
+    def resolve (self,scope):
+        for e in self._exps:
+            e.resolve(scope)
+
+    def optimize (self):
+        # the statements of nested blocks are spliced in, except for an
+        # empty last one, whose value is the value of the whole
+        exps = []
+        for e in self._exps:
+            e = e.optimize()
+            if type(e) is EDo and (e._exps or e is not self._exps[-1]):
+                exps.extend(e._exps)
+            else:
+                exps.append(e)
+        if len(exps) == 1:
+            return exps[0]
+        self._exps = exps
+        return self
+
+    def compile (self):
+        if not self._exps:
+            return lambda env: NONE
+        return self.compileLast(self._exps[-1].compile())
+
+    def compileTail (self):
+        if not self._exps:
+            return lambda env: NONE
+        return self.compileLast(self._exps[-1].compileTail())
+
+    def compileLast (self,last):
+        fs = [ e.compile() for e in self._exps[:-1] ]
+        if not fs:
+            return last
+        def f (env):
+            for g in fs:
+                g(env)
+            return last(env)
+        return f
+
 class EWhile (Exp):
 
     def __init__ (self,cond,exp):
@@ -201,14 +1026,191 @@ class EWhile (Exp):
 
     def eval (self,env):
         c = self._cond.eval(env)
-        if c.type != "boolean":
-            raise Exception ("Runtime error: while condition not a Boolean")
-        while c.value:
+        while c is not FALSE:
+            if c is not TRUE:
+                if c.type != "boolean":
+                    raise Exception ("Runtime error: while condition not a Boolean")
+                if not c.value:
+                    break
             self._exp.eval(env)
+            if STOPS:
+                stopped()
+            c = self._cond.eval(env)
+        return NONE
+
+    def resolve (self,scope):
+        self._cond.resolve(scope)
+        self._exp.resolve(scope)
+
+    def optimize (self):
+        self._cond = self._cond.optimize()
+        self._exp = self._exp.optimize()
+        return self
+
+    def compile (self):
+        # TRUE and FALSE are the only Booleans (see mkBoolean)
+        cond = self._cond.compile()
+        body = self._exp.compile()
+        def loop (env):
+            c = cond(env)
+            while c is TRUE:
+                body(env)
+                if STOPS:
+                    stopped()
+                c = cond(env)
+            if c is not FALSE:
+                raise Exception ("Runtime error: while condition not a Boolean")
+            return NONE
+        return loop
+
+class EFor (Exp):
+    # for i <- start; cond; i <- step; body
+    # Runs as its desugaring, EDo([init,EWhile(cond,EDo([body,step]))]).
+    # resolve() notes when the loop counts i up to a limit (see
+    # countedLoop), which then runs in a Python loop over an int, storing
+    # each value in i's ref cell for the body. Should the body update i
+    # or rebind < or +, the loop carries on as the desugaring
+
+    def __init__ (self,init,cond,step,body):
+        self._init = init
+        self._cond = cond
+        self._step = step
+        self._body = body
+        self._counted = None
+
+    def __str__ (self):
+        return "EFor({},{},{},{})".format(str(self._init),str(self._cond),str(self._step),str(self._body))
+
+    def eval (self,env):
+        self._init.eval(env)
+        state = self.counting(env)
+        if state is not None:
+            if self.runCounted(state,self._body.eval,env):
+                return NONE
+            self._step.eval(env)
+        c = self._cond.eval(env)
+        while c is not FALSE:
+            if c is not TRUE:
+                if c.type != "boolean":
+                    raise Exception ("Runtime error: while condition not a Boolean")
+                if not c.value:
+                    break
+            self._body.eval(env)
+            self._step.eval(env)
+            if STOPS:
+                stopped()
             c = self._cond.eval(env)
-            if c.type != "boolean":
+        return NONE
+
+    def counting (self,env):
+        # once init has run: [cell,value,i,limit] for the counted loop, or
+        # None to run the loop as its desugaring
+        if self._counted is None:
+            return None
+        (k,lt,plus) = self._counted
+        if not (builtinHolds(lt,env) and builtinHolds(plus,env)):
+            return None
+        cell = self._init._exps[0].eval(env)
+        limit = self._cond._args[1].eval(env)
+        if cell is None or cell.type != "ref" or limit.type != "integer":
+            return None
+        v = cell.content
+        if v.type != "integer":
+            return None
+        return [cell,v,v.value,limit.value]
+
+    def runCounted (self,state,body,env):
+        # run the counted loop, with body the function running the body;
+        # False when the body changed what the loop relies on, with the
+        # step of that round still to take
+        (cell,v,i,limit) = state
+        (k,lt,plus) = self._counted
+        (ltCell,ltClosure,plusCell,plusClosure) = (lt[2],lt[3],plus[2],plus[3])
+        while i < limit:
+            body(env)
+            if STOPS:
+                stopped()
+            if cell.content is not v or ltCell.content is not ltClosure or plusCell.content is not plusClosure:
+                return False
+            i += k
+            v = mkInteger(i)
+            cell.content = v
+        return True
+
+    def resolve (self,scope):
+        self._init.resolve(scope)
+        self._cond.resolve(scope)
+        self._step.resolve(scope)
+        self._body.resolve(scope)
+        self._counted = countedLoop(self)
+
+    def optimize (self):
+        self._init = self._init.optimize()
+        self._cond = self._cond.optimize()
+        self._step = self._step.optimize()
+        self._body = self._body.optimize()
+        return self
+
+    def compile (self):
+        (init,cond,step,body) = (self._init.compile(),self._cond.compile(),self._step.compile(),self._body.compile())
+        def f (env):
+            init(env)
+            state = self.counting(env)
+            if state is not None:
+                if self.runCounted(state,body,env):
+                    return NONE
+                step(env)
+            c = cond(env)
+            while c is TRUE:
+                body(env)
+                step(env)
+                if STOPS:
+                    stopped()
+                c = cond(env)
+            if c is not FALSE:
                 raise Exception ("Runtime error: while condition not a Boolean")
-        return VNone()
+            return NONE
+        return f
+
+
+def countedLoop (loop):
+    # For a resolved EFor of the shape
+    #     for i <- start; (< i limit); i <- (+ i k); body
+    # with k a positive integer, < and + the built-ins, and limit an
+    # integer or a variable that is never updated (see assignedNames):
+    # (k,lt,plus), with lt and plus the built-ins as noted by builtinOf.
+    # Otherwise None
+    def counter (e):
+        # the identifier e reads through its ref cell, if it does
+        if type(e) is EPrimCall and e._prim is oper_deref and len(e._exps) == 1 and type(e._exps[0]) is EId:
+            return e._exps[0]
+        return None
+    (init,cond,step) = (loop._init,loop._cond,loop._step)
+    if not (type(init) is EPrimCall and init._prim is oper_update and type(init._exps[0]) is EId):
+        return None
+    i = init._exps[0]
+    if i._depth is None:
+        return None
+    same = lambda e: e is not None and (e._id,e._depth,e._slot) == (i._id,i._depth,i._slot)
+    if not (type(cond) is ECall and len(cond._args) == 2 and same(counter(cond._args[0]))):
+        return None
+    limit = cond._args[1]
+    if not ((type(limit) is EValue and limit._value.type == "integer") or
+            (type(limit) is EId and limit._depth is not None and limit._id != i._id)):
+        return None
+    if not (type(step) is EPrimCall and step._prim is oper_update and same(step._exps[0])):
+        return None
+    add = step._exps[1]
+    if not (type(add) is ECall and len(add._args) == 2 and same(counter(add._args[0]))):
+        return None
+    k = add._args[1]
+    if not (type(k) is EValue and k._value.type == "integer" and k._value.value > 0):
+        return None
+    (lt,plus) = (cond._builtin,add._builtin)
+    if lt is None or plus is None or lt[4] is not oper_lt or plus[4] is not oper_plus:
+        return None
+    return (k._value.value,lt,plus)
+
 
 class EProcedure (Exp):
     # Creates an anonymous function
@@ -223,57 +1225,48 @@ class EProcedure (Exp):
     def eval (self,env):
         return VProcedure(self._params,self._body,env)
 
-class EWithArray (Exp):
-    def __init__ (self,exp1,exp2):
-        self._record = exp1
-        self._exp = exp2
-        
-    def __str__ (self):
-        return "EWithArray({},{})".format(str(self._record),str(self._exp))
+    def resolve (self,scope):
+        self._body.resolve(Scope(self._params,scope))
+        # drop the body's compiled form (see compiled), it may be stale
+        self._body._closure = None
 
-    def eval (self,env):
-        records = self._record.eval(env)[1]
-        return self._exp.eval(records+env)
+    def optimize (self):
+        self._body = self._body.optimize()
+        return self
+
+    def unbox (self,scope):
+        # the parameters hide the names bound outside
+        inner = dict(scope)
+        for p in self._params:
+            inner[p] = False
+        self._body = self._body.unbox(inner)
+        return self
+
+    def compile (self):
+        (params,body) = (self._params,self._body)
+        return lambda env: VProcedure(params,body,env)
 
 class EArray (Exp):
-    
+    # A new array of integers, all 0
+
     def __init__ (self,v):
-        self._value = [ VNone()]
         self._index = v
 
-
     def __str__ (self):
-        return "EArray({},{})".format(str(self._value),str(self._index))
+        return "EArray({})".format(str(self._index))
 
     def eval (self,env):
-        i = self._index.eval(env)
-        self._value = self._value * i.value
-        bind = [
-        ("index", 
-            VRefCell(VClosure(["x"],
-                                  EPrimCall(self.index,[EId("x")]),
-                                  env))),
-        ("length", 
-            VRefCell(VClosure([],
-                                  EPrimCall(self.length, []),
-                                  env))),
-        ("map", 
-            VRefCell(VClosure(["x"],
-                                  EPrimCall(self.mapA,[EId("x")]),
-                                  env)))
-        ]
-        return self._value, bind
-
-
-    def index(self,i):
-        return self._value[i.value]
-
-    def length(self):
-        return VInteger(len(self._value))
-    
-    def mapA(self,f):
-        return map(f, self._value) 
-    
+        n = self._index.eval(env)
+        if n.type != "integer" or n.value < 0:
+            raise Exception("Runtime error: array size must be a non-negative integer")
+        return VArray(intFilled(0,n.value))
+
+    def resolve (self,scope):
+        self._index.resolve(scope)
+
+    def optimize (self):
+        self._index = self._index.optimize()
+        return self
 
     
 #
@@ -281,38 +1274,55 @@ class EArray (Exp):
 #
 
 class Value (object):
-    pass
+    # Values carry their type as a class attribute, and have no instance
+    # dictionary. Booleans and none are singletons (TRUE, FALSE, NONE),
+    # and small integers are interned: make them with mkBoolean and
+    # mkInteger, and they can be compared by identity
+    __slots__ = ()
 
 
 class VInteger (Value):
     # Value representation of integers
+
+    __slots__ = ("value",)
+    type = "integer"
     
     def __init__ (self,i):
         self.value = i
-        self.type = "integer"
 
     def __str__ (self):
         return str(self.value)
 
+    def __reduce__ (self):
+        # small integers come back as the shared instances
+        return (mkInteger,(self.value,))
+
     
 class VBoolean (Value):
     # Value representation of Booleans
+
+    __slots__ = ("value",)
+    type = "boolean"
     
     def __init__ (self,b):
         self.value = b
-        self.type = "boolean"
 
     def __str__ (self):
         return "true" if self.value else "false"
 
+    def __reduce__ (self):
+        return "TRUE" if self.value else "FALSE"
+
     
 class VClosure (Value):
+
+    __slots__ = ("params","body","env")
+    type = "function"
     
     def __init__ (self,params,body,env):
         self.params = params
         self.body = body
         self.env = env
-        self.type = "function"
 
     def __str__ (self):
         return "<function [{}] {}>".format(",".join(self.params),str(self.body))
@@ -320,9 +1330,11 @@ class VClosure (Value):
     
 class VRefCell (Value):
 
+    __slots__ = ("content",)
+    type = "ref"
+
     def __init__ (self,initial):
         self.content = initial
-        self.type = "ref"
 
     def __str__ (self):
         return "<ref {}>".format(str(self.content))
@@ -330,42 +1342,332 @@ class VRefCell (Value):
 
 class VNone (Value):
 
-    def __init__ (self):
-        self.type = "none"
+    __slots__ = ()
+    type = "none"
 
     def __str__ (self):
         return "none"
 
+    def __reduce__ (self):
+        return "NONE"
+
 class VString (Value):
-    # Value representation of integers
+    # Value representation of strings
+    #
+    # A string is a window, _length characters from _start, on either a
+    # flat Python string or (after a concat) a rope: the first _nfront
+    # pieces of a list of them, last to first, followed by the first
+    # _nback pieces of another, first to last. The lists are shared with
+    # the strings the rope was built from, and so are the running totals
+    # of their lengths (_fends and _bends), by which a position is found
+    # in the rope without walking it. Concatenating onto the right of the
+    # string that last extended its back list appends to that list in
+    # place, and onto the left of the one that last extended its front
+    # list the same, so building a string up from either end takes time
+    # in proportion to its length. Substrings are windows on the same
+    # rope, and startswith and endswith only look at the pieces they
+    # compare. The characters are only put together when .value is asked
+    # for, which printing and comparisons do. Until then a string keeps
+    # the whole of the lists it shares alive
+
+    __slots__ = ("_flat","_start","_length","_front","_fends","_nfront","_back","_bends","_nback")
+    type = "string"
     
-    def __init__ (self,i):
-        self.value = i
-        self.type = "string"
+    def __init__ (self,s):
+        self._flat = s
+        self._start = 0
+        self._length = len(s)
+        self._front = None
+        self._back = None
 
     def __str__ (self):
-        return str(self.value)
+        return self.value
+
+    def length (self):
+        return self._length
+
+    @property
+    def value (self):
+        if self._flat is None:
+            self._flat = "".join(self.forward(0,self._length))
+            self._start = 0
+            self._front = self._fends = self._back = self._bends = None
+        elif self._start != 0 or self._length != len(self._flat):
+            self._flat = self._flat[self._start:self._start+self._length]
+            self._start = 0
+        return self._flat
+
+    def ropeLength (self):
+        # the number of characters in the whole rope
+        n = self._fends[self._nfront-1] if self._nfront else 0
+        return n + (self._bends[self._nback-1] if self._nback else 0)
+
+    def piece (self,g):
+        # the g-th piece of the rope, first to last, and where it starts
+        nfront = self._nfront
+        frontLength = self._fends[nfront-1] if nfront else 0
+        if g < nfront:
+            k = nfront - 1 - g
+            return (self._front[k],frontLength - self._fends[k])
+        k = g - nfront
+        return (self._back[k],frontLength + (self._bends[k-1] if k else 0))
+
+    def locate (self,p):
+        # the number of the piece of the rope holding its p-th character
+        nfront = self._nfront
+        frontLength = self._fends[nfront-1] if nfront else 0
+        if p < frontLength:
+            return nfront - 1 - bisect.bisect_left(self._fends,frontLength - p,0,nfront)
+        return nfront + bisect.bisect_right(self._bends,p - frontLength,0,self._nback)
+
+    def pieces (self):
+        # the characters of the string, in pieces, first to last
+        if self._flat is not None:
+            return (self._flat[self._start:self._start+self._length],)
+        return self.forward(0,self._length)
+
+    def forward (self,i,j):
+        # the characters from i to before j, in pieces, first to last
+        (i,j) = (self._start + i,self._start + j)
+        if self._flat is not None:
+            yield self._flat[i:j]
+            return
+        g = self.locate(i)
+        while i < j:
+            (piece,start) = self.piece(g)
+            end = start + len(piece)
+            yield piece if start >= i and end <= j else piece[max(i-start,0):min(j,end)-start]
+            i = end
+            g += 1
+
+    def backward (self,i,j):
+        # the characters from i to before j, in pieces, last to first
+        (i,j) = (self._start + i,self._start + j)
+        if self._flat is not None:
+            yield self._flat[i:j]
+            return
+        g = self.locate(j-1) if j > i else 0
+        while i < j:
+            (piece,start) = self.piece(g)
+            end = start + len(piece)
+            yield piece if start >= i and end <= j else piece[max(i-start,0):min(j,end)-start]
+            j = start
+            g -= 1
+
+    def view (self,i,j):
+        # the characters from i to before j, sharing this string's storage
+        v = VString.__new__(VString)
+        v._flat = self._flat
+        v._start = self._start + i
+        v._length = j - i
+        if self._flat is None:
+            (v._front,v._fends,v._nfront) = (self._front,self._fends,self._nfront)
+            (v._back,v._bends,v._nback) = (self._back,self._bends,self._nback)
+        else:
+            v._front = v._back = None
+        return v
+
+    def concat (self,other):
+        v = VString.__new__(VString)
+        v._flat = None
+        v._length = self._length + other._length
+        if (self._flat is None and self._nback == len(self._back) and
+            self._start + self._length == self.ropeLength()):
+            v._start = self._start
+            (v._front,v._fends,v._nfront) = (self._front,self._fends,self._nfront)
+            (v._back,v._bends) = (self._back,self._bends)
+            extend(v._back,v._bends,other.pieces())
+            v._nback = len(v._back)
+        elif other._flat is None and other._nfront == len(other._front) and other._start == 0:
+            v._start = 0
+            (v._back,v._bends,v._nback) = (other._back,other._bends,other._nback)
+            (v._front,v._fends) = (other._front,other._fends)
+            extend(v._front,v._fends,self.backward(0,self._length))
+            v._nfront = len(v._front)
+        else:
+            v._start = 0
+            (v._front,v._fends,v._nfront) = ([],[],0)
+            (v._back,v._bends) = ([],[])
+            extend(v._back,v._bends,self.forward(0,self._length))
+            extend(v._back,v._bends,other.forward(0,other._length))
+            v._nback = len(v._back)
+        return v
+
+    def startswith (self,prefix):
+        if len(prefix) > self._length:
+            return False
+        if not prefix:
+            return True
+        if self._flat is not None:
+            return self._flat.startswith(prefix,self._start,self._start+self._length)
+        (piece,start) = self.piece(self.locate(self._start))
+        if start + len(piece) - self._start >= len(prefix):
+            return piece.startswith(prefix,self._start - start)
+        i = 0
+        for piece in self.forward(0,len(prefix)):
+            if not prefix.startswith(piece,i):
+                return False
+            i += len(piece)
+        return True
+
+    def endswith (self,suffix):
+        if len(suffix) > self._length:
+            return False
+        if not suffix:
+            return True
+        end = self._start + self._length
+        if self._flat is not None:
+            return self._flat.endswith(suffix,self._start,end)
+        (piece,start) = self.piece(self.locate(end - 1))
+        if end - start >= len(suffix):
+            return piece.endswith(suffix,0,end - start)
+        i = len(suffix)
+        for piece in self.backward(self._length - len(suffix),self._length):
+            if not suffix.endswith(piece,0,i):
+                return False
+            i -= len(piece)
+        return True
+
+
+def extend (pieces,ends,more):
+    # add the strings in more to a list of pieces and its running total
+    # of their lengths
+    n = ends[-1] if ends else 0
+    for piece in more:
+        if piece:
+            n += len(piece)
+            pieces.append(piece)
+            ends.append(n)
 
 class VArray (Value):
-    def __init__ (self):
-        self.value = [ VNone() ]
-        self.type = "array"
+    # An array owns its elements. While they are all integers, they are
+    # kept unboxed in typed storage (see intStorage); storing anything
+    # else turns the storage into a list of values
+
+    __slots__ = ("value",)
+    type = "array"
+
+    def __init__ (self,storage):
+        self.value = storage
 
     def __str__ (self):
-        return str(self.value)
+        return "[{}]".format(",".join(str(v) for v in self.values()))
+
+    def typed (self):
+        return type(self.value) is not list
+
+    def check (self,i):
+        if i.type != "integer":
+            raise Exception("Runtime error: array index not an integer")
+        if not 0 <= i.value < len(self.value):
+            raise Exception("Runtime error: array index {} out of bounds".format(i.value))
+        return i.value
+
+    def get (self,i):
+        v = self.value[self.check(i)]
+        return mkInteger(int(v)) if self.typed() else v
+
+    def set (self,i,v):
+        i = self.check(i)
+        if self.typed():
+            if v.type == "integer":
+                try:
+                    self.value[i] = v.value
+                    return
+                except OverflowError:
+                    pass
+            self.value = self.values()
+        self.value[i] = v
+
+    def values (self):
+        # the elements, as a list of values
+        if self.typed():
+            return [ mkInteger(int(v)) for v in self.value ]
+        return list(self.value)
+
+
+# Integer arrays are stored in array("l") (64-bit integers on the usual
+# platforms), or NumPy int64 arrays once numpy_imp() has switched them on
+ARRAY_NUMPY = None
+
+
+def intStorage (ints):
+    # typed storage holding the Python integers ints
+    if ARRAY_NUMPY is not None:
+        return ARRAY_NUMPY.array(ints,dtype=ARRAY_NUMPY.int64)
+    return array("l",ints)
+
+
+def intFilled (i,n):
+    # typed storage holding the integer i n times
+    if ARRAY_NUMPY is not None:
+        return ARRAY_NUMPY.full(n,i,dtype=ARRAY_NUMPY.int64)
+    return array("l",[i]) * n
+
+
+def intSum (storage):
+    # the sum of typed storage, as a Python integer. NumPy sums in int64,
+    # which wraps around, so it is only used when it cannot overflow
+    if ARRAY_NUMPY is None:
+        return sum(storage)
+    if len(storage) == 0:
+        return 0
+    bound = max(-int(storage.min()),int(storage.max()))
+    if bound * len(storage) < 2 ** 63:
+        return int(storage.sum())
+    return sum(storage.tolist())
+
+
+def arrayOf (values):
+    # a new array of values, in typed storage if they are all integers
+    if all(v.type == "integer" for v in values):
+        try:
+            return VArray(intStorage([ v.value for v in values ]))
+        except OverflowError:
+            pass
+    return VArray(list(values))
+
+
+def numpy_imp ():
+    # store integer arrays in NumPy arrays from now on
+    global ARRAY_NUMPY
+    import numpy
+    ARRAY_NUMPY = numpy
 
 class VProcedure (Value):
 
+    __slots__ = ("params","body","env")
+    type = "procedure"
+
     def __init__(self,params,body,env):
         self.params = params
         self.body = body
         self.env = env
-        self.type = "procedure"
 
     def __str__(self):
         return "<procedure [{}] {}>".format(",".join(self.params),str(self.body))
 
 
+TRUE = VBoolean(True)
+FALSE = VBoolean(False)
+NONE = VNone()
+
+# integers in this range are interned
+SMALL_INT_MIN = -256
+SMALL_INT_MAX = 1024
+SMALL_INTS = [ VInteger(i) for i in range(SMALL_INT_MIN,SMALL_INT_MAX+1) ]
+
+
+def mkInteger (i):
+    if SMALL_INT_MIN <= i <= SMALL_INT_MAX:
+        return SMALL_INTS[i - SMALL_INT_MIN]
+    return VInteger(i)
+
+
+def mkBoolean (b):
+    return TRUE if b else FALSE
+
+
 ###############################################
 ###############################################
 ## MOST OF INHERITANCE AND POLYMORPHISM CODE ##
@@ -377,10 +1679,13 @@ class ENotImplemented (Exp):
     def eval(self,env):
         return VNotImplemented()
 
+    def resolve(self,scope):
+        pass
+
 class VNotImplemented (Value):
 
-    def __init__(self):
-        self.type = "notimplemented"
+    __slots__ = ()
+    type = "notimplemented"
 
     def __str__(self):
         return "<function not implemented>"
@@ -395,50 +1700,225 @@ class ETemplate(Value):
         self._defEnv = []
         self._params = [param for param in params]
         self._superargs = [superarg for superarg in superargs]
-        self._functions = functions
+        self._functions = [function for function in functions]
 
     def eval(self,env):
         scv = self._superclass.eval(env)
+        if scv.type != "template":
+            raise Exception("Runtime error: {} not defined as a template".format(self._superclass))
+        return self.build(scv)
+
+    def build(self,scv):
+        # the template of this class, as a subclass of the template scv
+        if len(self._superargs) != len(scv._params[0]):
+            raise Exception("Runtime error: superconstructor argument # mismatch")
         fullname = self._name + "." + scv._fullname
         fullparams = [self._params] + scv._params
-        superargs = [self._superargs] + scv._superargs
-
-        for envElem in scv._defEnv:
-            self._defEnv.insert(0,envElem)
 
-        self._defEnv = scv._defEnv[:]
+        # the method bodies and superconstructor arguments are copied, to
+        # read and update the fields in the object's frame (see
+        # EPrimCall.unbox); this definition is left as it was, to be built
+        # again on a new superclass (see VTemplate.redefine)
+        held = dict( (name,FIELD) for name in fieldLayout(fullparams) )
+        functions = [ (name,copy.deepcopy(f).unbox(held)) for (name,f) in self._functions ]
+        ownSuperargs = [ copy.deepcopy(e).unbox(held) for e in self._superargs ]
+        superargs = [ownSuperargs] + scv._superargs
+
+        # the class environment extends the superclass's one, so that
+        # inherited methods find everything at the same slots in both
+        self._defEnv = scv._defEnv.copy()
+        methods = dict(scv._methods)
+
+        for function in functions:
+            # methods are only ever run in an object's frame (see EWith
+            # and methodFrame)
+            functionv = function[1].eval(None)
+            self._defEnv.define(function[0],VRefCell(functionv))
+            methods[function[0]] = functionv
 
-        for function in self._functions:
-            # print(function[1].eval(env).type)
-            # if ((not self._isAbstract) and (function[1].eval(env).type == "notimplemented")):
-            #     raise Exception("Runtime error: Cannot create a concrete class with an abstract method")
-            self._defEnv.insert(0,(function[0],VRefCell(function[1].eval(env))))
-
-        names = set()
         if(not self._isAbstract):
-            for (name,envElem) in self._defEnv:
-                if(not name in names):
-                    if envElem.content.type  == "notimplemented":
-                        raise Exception("Runtime error: Cannot create a concrete class with an abstract method")
-                    else:
-                        names.add(name)
-
-        return VTemplate(self._isAbstract,self._name,fullname,fullparams,superargs,self._defEnv)
+            for envElem in self._defEnv.slots:
+                if envElem is not None and envElem.content.type == "notimplemented":
+                    raise Exception("Runtime error: Cannot create a concrete class with an abstract method")
+
+        template = VTemplate(self._isAbstract,self._name,fullname,fullparams,superargs,self._defEnv,methods,scv)
+
+        # method bodies and superconstructor arguments see the object's
+        # fields first, then the class environment
+        scope = Scope(template._fields,self._defEnv)
+        for function in functions:
+            function[1].resolve(scope)
+        for superarg in ownSuperargs:
+            superarg.resolve(scope)
+        template.plan()
+        template._definition = self
+
+        return template
+
+    def resolve(self,scope):
+        self._superclass.resolve(scope)
+
+    def optimize(self):
+        self._superargs = [ e.optimize() for e in self._superargs ]
+        self._functions = [ (name,f.optimize()) for (name,f) in self._functions ]
+        return self
+
+    def unbox(self,scope):
+        # done on each build, once the fields are known
+        return self
+
+    def compile(self):
+        return self.eval
+
+def fieldLayout(params):
+    # layout of an object's frame, for the parameters of each level of a
+    # class: the fields of the superclasses come first, so that a
+    # subclass's layout extends its superclass's one
+    fields = []
+    for level in reversed(params):
+        for param in level:
+            if param not in fields:
+                fields.append(param)
+    return fields
 
 class VTemplate(Value):
 
-    def __init__(self,isAbstract,name,fullname,params,superargs,defEnv):
-        self.type = "template"
+    type = "template"
+
+    def __init__(self,isAbstract,name,fullname,params,superargs,defEnv,methods=None,superclass=None):
         self._isAbstract = isAbstract
         self._name = name
         self._fullname = fullname
         self._params = params
         self._superargs = superargs
         self._defEnv = defEnv
+        # method table: the methods callable with `with`, by name
+        self._methods = {} if methods is None else methods
+        self._fields = fieldLayout(params)
+        self._fieldSlots = dict((name,i) for (i,name) in enumerate(self._fields))
+        # the templates this one is a subclass of, itself included
+        self._ancestors = frozenset([self])
+        if superclass is not None:
+            self._ancestors = self._ancestors | superclass._ancestors
+        self._plan = None
+        # for redefinition: the ETemplate this was made from, the
+        # templates made from it, its objects, and a count of its
+        # redefinitions, which dispatch caches check
+        self._superclass = superclass
+        self._definition = None
+        self._subclasses = weakref.WeakSet()
+        self._instances = weakref.WeakSet()
+        self._version = 0
+        if superclass is not None:
+            superclass._subclasses.add(self)
 
     def __str__(self):
         return "<template {}>".format(self._fullname)
 
+    def subclassOf(self,template):
+        return template in self._ancestors
+
+    def redefine(self,new):
+        # Take on the definition of new, made from a new definition of
+        # this class, in place, so that everything referring to this
+        # template sees it: bindings, objects (their fields are moved to
+        # the new layout if it changed), dispatch caches (through
+        # _version) and subclasses, which are made again from their own
+        # definitions on top of this one. A subclass whose definition no
+        # longer fits keeps its old one, which still works as it was
+        # Returns the messages for such subclasses
+        if self._superclass is not None:
+            self._superclass._subclasses.discard(self)
+        new._superclass._subclasses.discard(new)
+        new._superclass._subclasses.add(self)
+        fields = self._fields
+        self._defEnv.names = new._defEnv.names
+        self._defEnv.slots = new._defEnv.slots
+        for (name,value) in new.__dict__.items():
+            if name not in ("_defEnv","_subclasses","_instances","_version","_ancestors"):
+                setattr(self,name,value)
+        self._ancestors = frozenset([self]) | self._superclass._ancestors
+        self._version += 1
+
+        if self._fields != fields:
+            slots = [ fields.index(name) if name in fields else None for name in self._fields ]
+            for obj in list(self._instances):
+                obj.slots = [ NONE if i is None else obj.slots[i] for i in slots ]
+
+        kept = []
+        for subclass in list(self._subclasses):
+            if subclass._definition is None:
+                continue
+            try:
+                new = subclass._definition.build(self)
+            except Interrupt:
+                raise
+            except Exception as e:
+                kept.append("{} keeps its old definition ({})".format(subclass._fullname,e))
+                continue
+            kept.extend(subclass.redefine(new))
+        return kept
+
+    def __getstate__(self):
+        # weak references cannot be saved in an image
+        state = dict(self.__dict__)
+        state["_subclasses"] = list(self._subclasses)
+        state["_instances"] = list(self._instances)
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._subclasses = weakref.WeakSet(state["_subclasses"])
+        self._instances = weakref.WeakSet(state["_instances"])
+
+    def plan(self):
+        # The constructor plan, made once the superconstructor arguments
+        # are resolved: the slots the constructor arguments go in, then a
+        # store (slot,source slot,expression) for each superconstructor
+        # argument of each level in turn, which copies the field in the
+        # source slot if it has one, and evaluates the expression in the
+        # object otherwise. A superconstructor argument that only passes
+        # a field on to itself (like the a in "(a b) (a)") needs no store
+        if self._plan is None:
+            slots = self._fieldSlots
+            argSlots = [ slots[param] for param in self._params[0] ]
+            stores = []
+            stored = set(argSlots)
+            for (params,superargs) in zip(self._params[1:-1],self._superargs[:-1]):
+                for (param,superarg) in zip(params,superargs):
+                    slot = slots[param]
+                    source = fieldOf(superarg)
+                    if source is not None and source not in stored:
+                        source = None
+                    if source != slot:
+                        stores.append((slot,source,superarg))
+                        stored.add(slot)
+            self._plan = (argSlots,stores)
+        return self._plan
+
+    def instantiate(self,args):
+        # build an object from the values of the constructor arguments,
+        # following the constructor plan
+        (argSlots,stores) = self._plan or self.plan()
+        fields = [None] * len(self._fields)
+        for (slot,v) in zip(argSlots,args):
+            fields[slot] = v
+        obj = VObject(self,fields)
+        self._instances.add(obj)
+        for (slot,source,superarg) in stores:
+            if source is None:
+                fields[slot] = superarg.eval(obj)
+            else:
+                fields[slot] = fields[source]
+        return obj
+
+
+def fieldOf(exp):
+    # the slot of the object field exp reads, if that is all it does
+    if type(exp) is EField and exp._depth == 0:
+        return exp._slot
+    return None
+
 class EObject(Exp):
 
     def __init__(self,classid,args):
@@ -446,32 +1926,49 @@ class EObject(Exp):
         self._args = args
 
     def eval(self,env):
-        classtemp = self._class.eval(env)
+        classtemp = self.template(self._class.eval(env))
+        return classtemp.instantiate([ e.eval(env) for e in self._args ])
+
+    def template(self,classtemp):
+        # check that classtemp can be instantiated from this expression
         if classtemp.type != "template":
             raise Exception("Runtime error: {} not defined as a template".format(self._class))
         if classtemp._isAbstract:
             raise Exception("Runtime error: Cannot instantiate an abstract class")
         if len(classtemp._params[0])!=len(self._args):
             raise Exception("Runtime error: Must supply the following arguments".format(len(classtemp._params)))
-
-        newEnv = classtemp._defEnv
-        for i in range(len(self._args)):
-            newEnv.insert(0,(classtemp._params[0][i],VRefCell(self._args[i].eval(env))))
-
-        params = classtemp._params[1:-1]
-        superargs = classtemp._superargs[:-1]
-
-        for app in zip(params,superargs):
-            for i in range(len(app[0])):
-                newEnv.insert(0,(app[0][i],VRefCell(app[1][i].eval(newEnv))))
-
-        return VObject(classtemp,newEnv)
+        return classtemp
+
+    def resolve(self,scope):
+        self._class.resolve(scope)
+        for e in self._args:
+            e.resolve(scope)
+
+    def optimize(self):
+        self._args = [ e.optimize() for e in self._args ]
+        return self
+
+    def unbox(self,scope):
+        self._class = self._class.unbox(scope)
+        self._args = [ e.unbox(scope) for e in self._args ]
+        return self
+
+    def compile(self):
+        cls = self._class.compile()
+        fs = [ e.compile() for e in self._args ]
+        return lambda env: self.template(cls(env)).instantiate([ f(env) for f in fs ])
         
-class VObject(Value):
+class VObject(Value,Env):
+    # An object is the frame its methods run in. Its slots hold only its
+    # fields, laid out as in its class's _fields; methods and everything
+    # else are found in the class environment, its parent frame
 
-    def __init__(self,classt,env):
+    __slots__ = ("_class","__weakref__")
+    type = "object"
+
+    def __init__(self,classt,fields):
+        Env.__init__(self,fields,classt._defEnv)
         self._class = classt
-        self._env = env
 
     def __str__(self):
         return "<object of type {}>".format(self._class._fullname)
@@ -485,13 +1982,38 @@ class EObjectBinding(Exp):
     def eval(self,env):
         objectv = self._object.eval(env)
         templatev = self._template.eval(env)
+        return self.bind(objectv,templatev)
 
-        if(not (objectv._class._fullname.endswith(templatev._fullname))):
+    def bind(self,objectv,templatev):
+        if not objectv._class.subclassOf(templatev):
             raise Exception("Runtime error Cannot instantiate because {} is not of type {}".format(objectv._class._fullname,templatev._fullname))
         return VObjectBinding(templatev,objectv)
 
+    def resolve(self,scope):
+        self._template.resolve(scope)
+        self._object.resolve(scope)
+
+    def optimize(self):
+        self._object = self._object.optimize()
+        return self
+
+    def unbox(self,scope):
+        self._template = self._template.unbox(scope)
+        self._object = self._object.unbox(scope)
+        return self
+
+    def compile(self):
+        obj = self._object.compile()
+        template = self._template.compile()
+        def f (env):
+            objectv = obj(env)
+            return self.bind(objectv,template(env))
+        return f
+
 class VObjectBinding(Value):
 
+    __slots__ = ("_template","_object")
+
     def __init__(self,temp,obj):
         self._template = temp
         self._object = obj
@@ -500,25 +2022,344 @@ class VObjectBinding(Value):
         return "<object binding {} {}>".format(self._template,self._object)
 
 class EWith(Value):
+    # Each call site keeps an inline cache of the methods it called,
+    # keyed on the reference template and the class of the receiver
+
+    POLYMORPHIC_LIMIT = 8
 
     def __init__(self,obj,function,args):
         self._object = obj
         self._function = function
         self._args = args
+        self._cacheTemplate = None
+        self._cacheClass = None
+        self._cacheTemplateVersion = None
+        self._cacheVersion = None
+        self._cacheFunction = None
+        self._polyCache = {}
+
+    def method(self,templatev,classv):
+        # both versions count: redefining templatev bumps the versions of
+        # the subclasses made again on top of it, but not of those that
+        # keep their old definition (see VTemplate.redefine), which may
+        # still have a method templatev no longer has
+        (templateVersion,version) = (templatev._version,classv._version)
+        if (templatev is self._cacheTemplate and classv is self._cacheClass and
+            version == self._cacheVersion and templateVersion == self._cacheTemplateVersion):
+            return self._cacheFunction
+        (cachedTemplate,cached,functionv) = self._polyCache.get((templatev,classv),(None,None,None))
+        if cached != version or cachedTemplate != templateVersion:
+            if self._function not in templatev._methods or self._function not in classv._methods:
+                raise Exception("Runtime error: this function is not accessible or does not exist.")
+            functionv = classv._methods[self._function]
+            if len(self._polyCache) < EWith.POLYMORPHIC_LIMIT or (templatev,classv) in self._polyCache:
+                self._polyCache[(templatev,classv)] = (templateVersion,version,functionv)
+        self._cacheTemplate = templatev
+        self._cacheClass = classv
+        self._cacheTemplateVersion = templateVersion
+        self._cacheVersion = version
+        self._cacheFunction = functionv
+        return functionv
 
     def eval(self,env):
-        objectv = self._object.eval(env)._object
-        templatev = self._object.eval(env)._template
-        try:
-            self._function.eval(templatev._defEnv)
-        except Exception as e:
-            raise Exception("Runtime error: this function is not accessible or does not exist.")
-
-        functionv = self._function.eval(objectv._env)
+        (functionv,newEnv) = self.call(env)
+        callBody(functionv.body,newEnv)
+        return NONE
+
+    def evalTail(self,env):
+        (functionv,newEnv) = self.call(env)
+        return TailCall(functionv.body,newEnv)
+
+    def call(self,env):
+        # the method called and the frame to run it in
+        binding = self._object.eval(env)
+        objectv = binding._object
+        functionv = self.method(binding._template,objectv._class)
         args = [ e.eval(env) for e in self._args]
-        newEnv = zip(functionv.params,args) + objectv._env
-        functionv.body.eval(newEnv)
-        return VNone()
+        if len(args) != len(functionv.params):
+            raise Exception("Runtime error: argument # mismatch in call")
+        return (functionv,Env(args,objectv))
+
+    def resolve(self,scope):
+        self._object.resolve(scope)
+        for e in self._args:
+            e.resolve(scope)
+
+    def optimize(self):
+        self._args = [ e.optimize() for e in self._args ]
+        return self
+
+    def unbox(self,scope):
+        self._object = self._object.unbox(scope)
+        self._args = [ e.unbox(scope) for e in self._args ]
+        return self
+
+    def compile(self):
+        return self.compileCall(False)
+
+    def compileTail(self):
+        return self.compileCall(True)
+
+    def compileCall(self,tail):
+        obj = self._object.compile()
+        fs = [ e.compile() for e in self._args ]
+        def call (env):
+            binding = obj(env)
+            objectv = binding._object
+            functionv = self.method(binding._template,objectv._class)
+            args = [ f(env) for f in fs ]
+            if len(args) != len(functionv.params):
+                raise Exception("Runtime error: argument # mismatch in call")
+            if tail:
+                return TailCall(functionv.body,Env(args,objectv))
+            callCompiled(functionv.body,Env(args,objectv))
+            return NONE
+        return call
+
+
+#
+# Profiling
+#
+
+def expClasses ():
+    # every class of node with an eval method of its own
+    found = [ETemplate,EWith]
+    pending = [Exp]
+    while pending:
+        cls = pending.pop()
+        found.append(cls)
+        pending.extend(cls.__subclasses__())
+    return [ cls for cls in found if "eval" in cls.__dict__ ]
+
+
+class Profile (object):
+    # Evaluation counts and times per class of node, and per function,
+    # procedure or method called (methods are keyed by the class of the
+    # object and the method name). Times are "total", including what
+    # is evaluated underneath, and "own", without it.
+    # install() wraps the eval methods and uninstall() puts them back,
+    # so nothing is paid unless profiling is on. Only the tree engine
+    # evaluates through eval. A call in tail position is counted, but
+    # the time its body takes goes to the call it replaces
+
+    def __init__ (self):
+        self.nodes = {}
+        self.calls = {}
+        self._nested = [0.0]
+        self._frames = [[None,0.0]]
+        self._saved = None
+
+    def installed (self):
+        return self._saved is not None
+
+    def install (self):
+        if self._saved is not None:
+            return
+        self._saved = []
+        for cls in expClasses():
+            for name in ("eval","evalTail"):
+                if name not in cls.__dict__:
+                    continue
+                eval = cls.__dict__[name]
+                if cls is ECall:
+                    eval = self.timeCall(eval,lambda node: "function " + callee(node))
+                elif cls is EProcCall:
+                    eval = self.timeCall(eval,lambda node: "procedure " + callee(node))
+                elif cls is EWith:
+                    # the class is only known once the object is evaluated;
+                    # method() names the frame
+                    eval = self.timeCall(eval,lambda node: None)
+                self.replace(cls,name,self.timeNode(eval,cls.__name__))
+        self.replace(EWith,"method",self.nameMethod(EWith.__dict__["method"]))
+
+    def uninstall (self):
+        if self._saved is None:
+            return
+        for (cls,name,f) in reversed(self._saved):
+            setattr(cls,name,f)
+        self._saved = None
+
+    def reset (self):
+        self.nodes.clear()
+        self.calls.clear()
+
+    def replace (self,cls,name,f):
+        self._saved.append((cls,name,cls.__dict__[name]))
+        setattr(cls,name,f)
+
+    def timeNode (self,eval,name):
+        nodes = self.nodes
+        nested = self._nested
+        def timed (node,env):
+            nested.append(0.0)
+            start = time.time()
+            try:
+                return eval(node,env)
+            finally:
+                elapsed = time.time() - start
+                own = elapsed - nested.pop()
+                nested[-1] += elapsed
+                stats = nodes.get(name)
+                if stats is None:
+                    stats = nodes[name] = [0,0.0,0.0]
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] += own
+        return timed
+
+    def timeCall (self,eval,key):
+        calls = self.calls
+        frames = self._frames
+        def timed (node,env):
+            frames.append([key(node),0.0])
+            start = time.time()
+            try:
+                return eval(node,env)
+            finally:
+                elapsed = time.time() - start
+                (name,nested) = frames.pop()
+                frames[-1][1] += elapsed
+                if name is not None:
+                    stats = calls.get(name)
+                    if stats is None:
+                        stats = calls[name] = [0,0.0,0.0]
+                    stats[0] += 1
+                    stats[1] += elapsed
+                    stats[2] += elapsed - nested
+        return timed
+
+    def nameMethod (self,method):
+        frames = self._frames
+        def named (node,templatev,classv):
+            functionv = method(node,templatev,classv)
+            frames[-1][0] = "method {}.{}".format(classv._fullname,node._function)
+            return functionv
+        return named
+
+    def report (self,limit=None):
+        # the counters as a table, biggest own time first
+        lines = []
+        for (title,table) in (("node",self.nodes),("call",self.calls)):
+            rows = sorted(table.items(),key=lambda item: -item[1][2])[:limit]
+            width = max([len(title)] + [ len(name) for (name,stats) in rows ])
+            lines.append("{:<{}} {:>10} {:>10} {:>10}".format(title,width,"count","total(s)","own(s)"))
+            for (name,(count,total,own)) in rows:
+                lines.append("{:<{}} {:>10} {:>10.4f} {:>10.4f}".format(name,width,count,total,own))
+            lines.append("")
+        return "\n".join(lines)
+
+
+def callee (node):
+    # the name a function or procedure is called by, if any
+    return calleeName(node._fun) or "<anonymous>"
+
+
+PROFILE_IMP = Profile()
+
+
+#
+# Census
+#
+# What the values and environments alive take up: objects by class (the
+# full name of their template), other values and environments by kind,
+# each with a count and approximate bytes (the Python object and the
+# containers it owns, like an environment's slots; not the values in
+# them), and for environments the total number of slots. The shared
+# small integers and Booleans are left out.
+# Everything the garbage collector knows of is counted, or with a root
+# (eg, one session's global environment), only what it leads to
+
+def footprint (obj):
+    # approximate bytes taken by obj and the containers it owns
+    size = sys.getsizeof(obj)
+    if isinstance(obj,Env):
+        size += sys.getsizeof(obj.slots)
+        if type(obj) is RootEnv:
+            size += sys.getsizeof(obj.names)
+    elif type(obj) is VString:
+        if obj._flat is not None:
+            size += sys.getsizeof(obj._flat)
+        else:
+            size += sum( sys.getsizeof(l) for l in (obj._front,obj._fends,obj._back,obj._bends) )
+    elif type(obj) is VArray:
+        size += sys.getsizeof(obj.value)
+    return size
+
+
+def shared (v):
+    # is v one of the values made once and shared (see mkInteger)?
+    if type(v) is VInteger:
+        return SMALL_INT_MIN <= v.value <= SMALL_INT_MAX and SMALL_INTS[v.value-SMALL_INT_MIN] is v
+    return v is TRUE or v is FALSE
+
+
+def reachable (root):
+    # the values, environments and expressions root leads to, through
+    # them and plain containers only (not classes, functions or modules)
+    follow = (Value,Env,Exp,TailCall,list,tuple,dict,set,frozenset,ParseResults)
+    seen = set([id(root)])
+    pending = [root]
+    while pending:
+        obj = pending.pop()
+        yield obj
+        for ref in gc.get_referents(obj):
+            if id(ref) not in seen and isinstance(ref,follow):
+                seen.add(id(ref))
+                pending.append(ref)
+
+
+def census_imp (root=None):
+    # the census, as a dictionary of tables of {"count","bytes"(,"slots")}
+    objects = {}
+    values = {}
+    envs = {}
+    for obj in (gc.get_objects() if root is None else reachable(root)):
+        if type(obj) is VObject:
+            row = objects.setdefault(obj._class._fullname,{"count":0,"bytes":0})
+        elif isinstance(obj,Env):
+            row = envs.setdefault(type(obj).__name__,{"count":0,"bytes":0,"slots":0})
+            row["slots"] += len(obj.slots)
+        elif isinstance(obj,Value) and not isinstance(obj,(ETemplate,EWith)) and not shared(obj):
+            row = values.setdefault(type(obj).__name__,{"count":0,"bytes":0})
+        else:
+            continue
+        row["count"] += 1
+        row["bytes"] += footprint(obj)
+    return {"time":time.time(),"objects":objects,"values":values,"envs":envs}
+
+
+def census_report (census):
+    # the census as tables, biggest first
+    lines = []
+    for (title,table,columns) in (("object",census["objects"],["count","bytes"]),
+                                  ("value",census["values"],["count","bytes"]),
+                                  ("environment",census["envs"],["count","bytes","slots"])):
+        rows = sorted(table.items(),key=lambda item: -item[1]["bytes"])
+        width = max([len(title)] + [ len(name) for (name,row) in rows ])
+        lines.append("{:<{}}".format(title,width) + "".join([ " {:>10}".format(c) for c in columns ]))
+        for (name,row) in rows:
+            lines.append("{:<{}}".format(name,width) + "".join([ " {:>10}".format(row[c]) for c in columns ]))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def census_dump (census):
+    return json.dumps(census,sort_keys=True,separators=(",",":"))
+
+
+def sample_census_imp (path,every):
+    # append the census to path as a line of JSON every so many seconds,
+    # from a background thread
+    import threading
+    def sample ():
+        while True:
+            time.sleep(every)
+            with open(path,"a") as f:
+                f.write(census_dump(census_imp()) + "\n")
+    thread = threading.Thread(target=sample)
+    thread.daemon = True
+    thread.start()
+    return thread
 
 ###############################################
 ###############################################
@@ -528,77 +2369,82 @@ class EWith(Value):
 
 def oper_lt (v1, v2):
   if v1.type == "integer" and v2.type == "integer":
-        return VBoolean(v1.value < v2.value)
+        return mkBoolean(v1.value < v2.value)
   raise Exception ("Runtime error: trying to compare non-numbers")
   
 def oper_gt (v1, v2):
   if v1.type == "integer" and v2.type == "integer":
-        return VBoolean(v1.value > v2.value)
+        return mkBoolean(v1.value > v2.value)
   raise Exception ("Runtime error: trying to compare non-numbers")
   
 def oper_le (v1, v2):
   if v1.type == "integer" and v2.type == "integer":
-        return VBoolean(v1.value <= v2.value)
+        return mkBoolean(v1.value <= v2.value)
   raise Exception ("Runtime error: trying to compare non-numbers")
   
 def oper_ge (v1, v2):
   if v1.type == "integer" and v2.type == "integer":
-        return VBoolean(v1.value >= v2.value)
+        return mkBoolean(v1.value >= v2.value)
   raise Exception ("Runtime error: trying to compare non-numbers")
 
 def oper_eq (v1, v2):
+  if v1 is v2 and v1.type == "integer":
+        return TRUE
   if v1.type == "integer" and v2.type == "integer":
-        return VBoolean(v1.value == v2.value)
+        return mkBoolean(v1.value == v2.value)
   raise Exception ("Runtime error: trying to compare non-numbers")
 
 def oper_plus (v1,v2): 
     if v1.type == "integer" and v2.type == "integer":
-        return VInteger(v1.value + v2.value)
+        return mkInteger(v1.value + v2.value)
     raise Exception ("Runtime error: trying to add non-numbers")
 
 def oper_minus (v1,v2):
     if v1.type == "integer" and v2.type == "integer":
-        return VInteger(v1.value - v2.value)
+        return mkInteger(v1.value - v2.value)
     raise Exception ("Runtime error: trying to subtract non-numbers")
 
 def oper_times (v1,v2):
     if v1.type == "integer" and v2.type == "integer":
-        return VInteger(v1.value * v2.value)
+        return mkInteger(v1.value * v2.value)
     raise Exception ("Runtime error: trying to multiply non-numbers")
 
 def oper_divide_i (v1,v2):
     if v1.type == "integer" and v2.type == "integer":
-        return VInteger(int(v1.value / v2.value))
+        return mkInteger(int(v1.value / v2.value))
     raise Exception ("Runtime error: trying to divide non-numbers")
 
 def oper_zero (v1):
     if v1.type == "integer":
-        return VBoolean(v1.value==0)
+        return mkBoolean(v1.value==0)
     raise Exception ("Runtime error: type error in zero?")
 
-def oper_length(v1): # (returns the length of a string)
+def oper_length(v1): # (returns the length of a string or an array)
     if v1.type == "string":
-        return VInteger(len(v1.value))
+        return mkInteger(v1.length())
+    if v1.type == "array":
+        return mkInteger(len(v1.value))
     raise Exception ("Runtime error: not a string")
 
-def oper_substring(v1,v2,v3): # (returns part of a string as a new string)
+def oper_substring(v1,v2,v3): # (returns part of a string, sharing its characters)
     if v1.type == "string" and v2.type == "integer" and v3.type == "integer":
-        return VString(v1.value[v2.value:v3.value])
+        (i,j,step) = slice(v2.value,v3.value).indices(v1.length())
+        return v1.view(i,max(i,j))
     raise Exception ("Runtime error: not a string")
 
 def oper_concat(v1,v2): # (concatenate two strings into a new one)
     if v1.type == "string" and v2.type == "string":
-        return VString(v1.value + v2.value)
+        return v1.concat(v2)
     raise Exception ("Runtime error: not a string")
 
 def oper_startswith(v1,v2): # (check if a string starts with another string)
     if v1.type == "string" and v2.type == "string":
-        return VBoolean(v1.value.startswith(v2.value))
+        return mkBoolean(v1.startswith(v2.value))
     raise Exception ("Runtime error: not a string")
 
 def oper_endswith(v1,v2): # (check if a string ends with another string)
     if v1.type == "string" and v2.type == "string":
-        return VBoolean(v1.value.endswith(v2.value))
+        return mkBoolean(v1.endswith(v2.value))
     raise Exception ("Runtime error: not a string")
 
 def oper_lower(v1): # (converts every character of a string into lowercase, returning a new string)
@@ -619,18 +2465,117 @@ def oper_deref (v1):
 def oper_update (v1,v2):
     if v1.type == "ref":
         v1.content = v2
-        return VNone()
+        return NONE
     raise Exception ("Runtime error: updating a non-reference value")
 
 def oper_update_arr (v1,v2,v3):
     if v1.type == "ref":
-        v1.content[0][v3.value] = v2
-        return VNone()
+        return oper_update_elt(v1.content,v2,v3)
     raise Exception ("Runtime error: updating a non-reference value")
+
+def oper_update_elt (v1,v2,v3):
+    # oper_update_arr on the array itself, held in an object's field
+    if v1.type != "array":
+        raise Exception ("Runtime error: updating an element of a non-array")
+    v1.set(v3,v2)
+    return NONE
+
+
+# Arrays
+#
+# The bulk operations work on the whole storage at once. Primitives of
+# the initial environment passed to map and reduce are applied directly;
+# other functions are called for each element
+
+def checkArray (v,name):
+    if v.type != "array":
+        raise Exception ("Runtime error: {} of a non-array".format(name))
+
+def applyFunction (f,args):
+    # call the function value f from a primitive
+    if f.type != "function":
+        raise Exception("Runtime error: trying to call a non-function")
+    if len(args) != len(f.params):
+        raise Exception("Runtime error: argument # mismatch in call")
+    prim = primitiveOf(f.body)
+    if prim is not None:
+        return prim(*args)
+    return callBody(f.body,Env(args,f.env))
+
+def oper_index (v1,v2): # (the element of an array at an index)
+    checkArray(v1,"index")
+    return v1.get(v2)
+
+def oper_fill (v1,v2): # (set every element of an array, returning it)
+    checkArray(v1,"fill")
+    n = len(v1.value)
+    if v2.type == "integer":
+        try:
+            v1.value = intFilled(v2.value,n)
+            return v1
+        except OverflowError:
+            pass
+    v1.value = [v2] * n
+    return v1
+
+def oper_slice (v1,v2,v3): # (a new array of the elements from one index to before another)
+    checkArray(v1,"slice")
+    if v2.type != "integer" or v3.type != "integer":
+        raise Exception ("Runtime error: array index not an integer")
+    if not 0 <= v2.value <= v3.value <= len(v1.value):
+        raise Exception ("Runtime error: slice {} {} out of bounds".format(v2.value,v3.value))
+    part = v1.value[v2.value:v3.value]
+    if ARRAY_NUMPY is not None and v1.typed():
+        # a NumPy slice is a view
+        part = part.copy()
+    return VArray(part)
+
+def oper_map (v1,v2): # (a new array of a function applied to each element)
+    checkArray(v2,"map")
+    return arrayOf([ applyFunction(v1,[v]) for v in v2.values() ])
+
+def oper_reduce (v1,v2,v3): # (combine the elements with a function, from an initial value)
+    checkArray(v3,"reduce")
+    prim = primitiveOf(v1.body) if v1.type == "function" else None
+    if v3.typed() and v2.type == "integer" and prim is oper_plus:
+        return mkInteger(v2.value + intSum(v3.value))
+    acc = v2
+    for v in v3.values():
+        acc = applyFunction(v1,[acc,v])
+    return acc
+
+def oper_sum (v1): # (the sum of an array of integers)
+    checkArray(v1,"sum")
+    if v1.typed():
+        return mkInteger(intSum(v1.value))
+    return reduce(oper_plus,v1.value,mkInteger(0))
+
+def oper_sort (v1): # (sort an array of integers or of strings in place, returning it)
+    checkArray(v1,"sort")
+    if ARRAY_NUMPY is not None and v1.typed():
+        v1.value.sort()
+    elif v1.typed():
+        v1.value = intStorage(sorted(v1.value))
+    else:
+        types = set(v.type for v in v1.value)
+        if len(types) > 1 or not types <= set(["integer","string"]):
+            raise Exception ("Runtime error: sorting an array of mixed or unordered values")
+        v1.value.sort(key=lambda v: v.value)
+    return v1
  
 def oper_print (v1):
     print v1
-    return VNone()
+    return NONE
+
+
+# the built-ins the optimizer may apply to constants, by name
+FOLDABLE_PRIMS = {
+    "+":oper_plus, "-":oper_minus, "*":oper_times, "/":oper_divide_i,
+    "zero?":oper_zero, "<":oper_lt, ">":oper_gt, "<=":oper_le, ">=":oper_ge,
+    "==":oper_eq, "length":oper_length, "substring":oper_substring,
+    "concat":oper_concat, "startswith":oper_startswith,
+    "endswith":oper_endswith, "lower":oper_lower, "upper":oper_upper,
+}
 
     
 ############################################################
@@ -644,114 +2589,52 @@ def oper_print (v1):
 ##
 # cf http://pyparsing.wikispaces.com/
 
-from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, Keyword, Forward, alphas, alphanums, NoMatch, quotedString
+from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, Optional, Keyword, Forward, alphas, alphanums, NoMatch, quotedString, ParserElement, Regex, ParseException, ParseResults
 
 
 def initial_env_imp ():
     # A sneaky way to allow functions to refer to functions that are not
     # yet defined at top level, or recursive functions
-    env = []
-    env.insert(0,
-               ("+",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_plus,[EId("x"),EId("y")]),
-                                  env))))
-    env.insert(0,
-               ("-",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_minus,[EId("x"),EId("y")]),
-                                  env))))
-    env.insert(0,
-               ("*",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_times,[EId("x"),EId("y")]),
-                                  env))))
-    env.insert(0,
-               ("/",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_divide_i,[EId("x"),EId("y")]),
-                                  env))))
-    env.insert(0,
-               ("zero?",
-                VRefCell(VClosure(["x"],
-                                  EPrimCall(oper_zero,[EId("x")]),
-                                  env))))
-    env.insert(0,
-               ("<",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_lt,[EId("x"),EId("y")]),
-                                  env))))
-                                  
-    env.insert(0,
-               (">",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_gt,[EId("x"),EId("y")]),
-                                  env))))
-                                  
-    env.insert(0,
-               ("<=",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_le,[EId("x"),EId("y")]),
-                                  env))))
-                                  
-    env.insert(0,
-               (">=",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_ge,[EId("x"),EId("y")]),
-                                  env))))
-
-    env.insert(0,
-               ("==",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_eq,[EId("x"),EId("y")]),
-                                  env))))
-    env.insert(0,
-               ("length",
-                VRefCell(VClosure(["x"],
-                                  EPrimCall(oper_length,[EId("x")]),
-                                  env))))
-    env.insert(0,
-               ("substring",
-                VRefCell(VClosure(["x", "y", "z"],
-                                  EPrimCall(oper_substring,[EId("x"),EId("y"),EId("z")]),
-                                  env))))
-
-    env.insert(0,
-               ("concat",
-                VRefCell(VClosure(["x", "y"],
-                                  EPrimCall(oper_concat,[EId("x"),EId("y")]),
-                                  env))))
-
-    env.insert(0,
-               ("startswith",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_startswith,[EId("x"),EId("y")]),
-                                  env))))
-
-    env.insert(0,
-               ("endswith",
-                VRefCell(VClosure(["x","y"],
-                                  EPrimCall(oper_endswith,[EId("x"),EId("y")]),
-                                  env))))
-
-    env.insert(0,
-               ("lower",
-                VRefCell(VClosure(["x"],
-                                  EPrimCall(oper_lower,[EId("x")]),
-                                  env))))
-    env.insert(0,
-               ("upper",
-                VRefCell(VClosure(["x"],
-                                  EPrimCall(oper_upper,[EId("x")]),
-                                  env))))
+    env = RootEnv()
+
+    def mkPrim (name,params,oper):
+        body = EPrimCall(oper,[ EId(p) for p in params ])
+        body.resolve(Scope(params,None))
+        env.define(name,VRefCell(VClosure(params,body,env)))
+
+    mkPrim("+",["x","y"],oper_plus)
+    mkPrim("-",["x","y"],oper_minus)
+    mkPrim("*",["x","y"],oper_times)
+    mkPrim("/",["x","y"],oper_divide_i)
+    mkPrim("zero?",["x"],oper_zero)
+    mkPrim("<",["x","y"],oper_lt)
+    mkPrim(">",["x","y"],oper_gt)
+    mkPrim("<=",["x","y"],oper_le)
+    mkPrim(">=",["x","y"],oper_ge)
+    mkPrim("==",["x","y"],oper_eq)
+    mkPrim("length",["x"],oper_length)
+    mkPrim("substring",["x","y","z"],oper_substring)
+    mkPrim("concat",["x","y"],oper_concat)
+    mkPrim("startswith",["x","y"],oper_startswith)
+    mkPrim("endswith",["x","y"],oper_endswith)
+    mkPrim("lower",["x"],oper_lower)
+    mkPrim("upper",["x"],oper_upper)
+    mkPrim("index",["x","y"],oper_index)
+    mkPrim("fill",["x","y"],oper_fill)
+    mkPrim("slice",["x","y","z"],oper_slice)
+    mkPrim("map",["x","y"],oper_map)
+    mkPrim("reduce",["x","y","z"],oper_reduce)
+    mkPrim("sum",["x"],oper_sum)
+    mkPrim("sort",["x"],oper_sort)
 
     return env
 
 
 
 
-def parse_imp (input):
-    # parse a string into an element of the abstract representation
+def grammar_imp ():
+    # build the parser for a top-level form
+    # (this is expensive, so it is done once when the module is loaded)
 
     # Grammar:
     #
@@ -762,6 +2645,7 @@ def parse_imp (input):
     #            ( if <expr> <expr> <expr> )
     #            ( function ( <name ... ) <expr> )    
     #            ( <expr> <expr> ... )
+    #            new <identifier> ( <expr> ... )
     #
     # <decl> ::= var name = expr ; 
     #
@@ -794,10 +2678,10 @@ def parse_imp (input):
     pNAMES.setParseAction(lambda result: [result])
 
     pINTEGER = Word("0123456789")
-    pINTEGER.setParseAction(lambda result: EValue(VInteger(int(result[0]))))
+    pINTEGER.setParseAction(lambda result: EValue(mkInteger(int(result[0]))))
 
     pBOOLEAN = Keyword("true") | Keyword("false")
-    pBOOLEAN.setParseAction(lambda result: EValue(VBoolean(result[0]=="true")))
+    pBOOLEAN.setParseAction(lambda result: EValue(mkBoolean(result[0]=="true")))
     
     def escapeString(inStr):
         inStr = inStr[1:-1]
@@ -839,7 +2723,11 @@ def parse_imp (input):
     pCALL = "(" + pEXPR + pEXPRS + ")"
     pCALL.setParseAction(lambda result: ECall(result[1],result[2]))
 
-    pEXPR << (pINTEGER | pBOOLEAN | pSTRING | pIDENTIFIER | pIF | pFUN | pCALL)
+    # a new object, bound as an object of its own class
+    pNEW = Keyword("new",identChars=idChars+"0123456789") + pIDENTIFIER + "(" + pEXPRS + ")"
+    pNEW.setParseAction(lambda result: EObjectBinding(copy.deepcopy(result[1]),EObject(result[1],result[3])))
+
+    pEXPR << (pINTEGER | pBOOLEAN | pSTRING | pNEW | pIDENTIFIER | pIF | pFUN | pCALL)
 
     pDECL_VAR = "var" + pNAME + "=" + pEXPR + ";"
     pDECL_VAR.setParseAction(lambda result: (result[1],result[3]))    
@@ -862,7 +2750,7 @@ def parse_imp (input):
     pSTMT_IF_1.setParseAction(lambda result: EIf(result[1],result[2],result[4]))
 
     pSTMT_IF_2 = "if" + pEXPR + pSTMT
-    pSTMT_IF_2.setParseAction(lambda result: EIf(result[1],result[2],EValue(VBoolean(True))))
+    pSTMT_IF_2.setParseAction(lambda result: EIf(result[1],result[2],EValue(TRUE)))
    
     pSTMT_WHILE = "while" + pEXPR + pSTMT
     pSTMT_WHILE.setParseAction(lambda result: EWhile(result[1],result[2]))
@@ -880,7 +2768,7 @@ def parse_imp (input):
     # pSTMT_FOR.setParseAction(lambda result: EDo([result[2],EWhile(result[3], EDo([result[7],result[5]])) ] ))
 
     pSTMT_FOR = "for" + pSTMT_UPDATE + pEXPR + ";" + pSTMT_UPDATE + pSTMT
-    pSTMT_FOR.setParseAction(lambda result: EDo([result[1],EWhile(result[2], EDo([result[5],result[4]])) ] ))
+    pSTMT_FOR.setParseAction(lambda result: EFor(result[1],result[2],result[4],result[5]))
 
     pSTMTS = ZeroOrMore(pSTMT)
     pSTMTS.setParseAction(lambda result: [result])
@@ -899,7 +2787,7 @@ def parse_imp (input):
     pSTMT_PROC = pIDENTIFIER + "(" + pEXPRS + ")" + ";"
     pSTMT_PROC.setParseAction(lambda result: EProcCall(result[0],result[2]))
 
-    pWITH = "(" + Keyword("with") + pIDENTIFIER + pIDENTIFIER + "(" + pEXPRS +")" + ")"
+    pWITH = "(" + Keyword("with") + pIDENTIFIER + pNAME + "(" + pEXPRS +")" + ")"
     pWITH.setParseAction(lambda result: EWith(result[2],result[3],result[5]))
 
     pNOTIMPLEMENTED = Keyword("<>")
@@ -950,23 +2838,666 @@ def parse_imp (input):
     pMULTI = Keyword("#multi")
     pMULTI.setParseAction(lambda result: {"result":"multi"})
 
-    pTOP = (pQUIT | pABSTRACT | pTOP_DECL | pTOP_STMT | pDEFPROC | pTEMPLATE | pOBJASS | pMULTI | pABSTEMPLATE)
+    pPROFILE = Keyword("#profile") + Optional(Keyword("on") | Keyword("off") | Keyword("reset"))
+    pPROFILE.setParseAction(lambda result: {"result":"profile",
+                                            "arg":result[1] if len(result) > 1 else None})
+
+    pCENSUS = Keyword("#census") + Optional(Keyword("json"))
+    pCENSUS.setParseAction(lambda result: {"result":"census",
+                                           "arg":result[1] if len(result) > 1 else None})
+
+    pTOP = (pQUIT | pABSTRACT | pTOP_DECL | pTOP_STMT | pDEFPROC | pTEMPLATE | pOBJASS | pMULTI | pPROFILE | pCENSUS | pABSTEMPLATE)
+
+    return pTOP
+
+
+pTOP_IMP = grammar_imp()
+
+# a top-level form followed by whatever text comes after it
+pFORM_IMP = pTOP_IMP + Regex(r"[\s\S]*")
+
+# pyparsing elements keep state while they parse, so threads reading
+# forms at the same time cannot share them: each thread gets grammars
+# of its own (see formGrammar), the thread importing this the ones above
+GRAMMARS = threading.local()
+GRAMMARS.form = pFORM_IMP
+
+
+def formGrammar ():
+    # pFORM_IMP, made for the thread calling this
+    form = getattr(GRAMMARS,"form",None)
+    if form is None:
+        form = GRAMMARS.form = grammar_imp() + Regex(r"[\s\S]*")
+    return form
+
 
-    result = pTOP.parseString(input)[0]
+def packrat_imp ():
+    # Turn on memoized (packrat) parsing. The alternatives that share a
+    # prefix, like pSTMT_IF_1 | pSTMT_IF_2 or pDEFFUN | pDEFABSFUN, then
+    # reuse what they already parsed instead of backtracking over it,
+    # which matters a lot on nested class bodies.
+    # This is a global pyparsing setting, and cannot be turned off again:
+    # it holds for every grammar in the process (see formGrammar), and its
+    # one cache is not made to be used by several threads at once. So
+    # only main_imp turns it on, for the scripts or shell of the process
+    # it runs in (and the pool's worker processes); a server, or a program
+    # parsing in several threads, must leave it off.
+    # The cache is cleared before each parse, so it is left unbounded
+    ParserElement.enablePackrat(None)
+
+
+def parse_imp (input):
+    # parse a string into an element of the abstract representation
+
+    result = pTOP_IMP.parseString(input)[0]
     return result    # the first element of the result is the expression
 
 
-def shell_imp ():
+def optimize_imp (result):
+    # Simplify the expressions of a parsed top-level form, before it is
+    # resolved: fold built-ins applied to constants, keep only the branch
+    # of an if on a literal condition, splice nested blocks together and
+    # drop unused local bindings (see the optimize methods)
+    # Returns (the number of nodes eliminated, the number of constants
+    # folded). A folded constant keeps the expression it was folded from,
+    # in case the built-ins turn out to be rebound when it runs, so
+    # folding eliminates no nodes
+
+    forms = { "statement":"stmt", "declaration":"decl", "procedure":"proc",
+              "template":"temp", "objectassignment":"assignment" }
+    if result["result"] not in forms:
+        return (0,0)
+    key = forms[result["result"]]
+    if key == "stmt":
+        before = countNodes(result[key])
+        result[key] = result[key].optimize()
+        return (before - countNodes(result[key]),countFolds(result[key]))
+    (name,exp) = result[key]
+    before = countNodes(exp)
+    exp = exp.optimize()
+    result[key] = (name,exp)
+    return (before - countNodes(exp),countFolds(exp))
+
+
+def optimizerReport (eliminated,folded):
+    # what optimize_imp did, as told to the user
+    return "optimizer eliminated {} nodes and folded {} constants (checked when run)".format(eliminated,folded)
+
+
+def unbox_imp (result):
+    # unbox the variables of a parsed top-level form that are never
+    # updated (see assignedNames); globals keep their ref cells
+
+    forms = { "statement":"stmt", "declaration":"decl", "procedure":"proc",
+              "template":"temp", "objectassignment":"assignment" }
+    if result["result"] not in forms:
+        return
+    key = forms[result["result"]]
+    if key == "stmt":
+        result[key] = result[key].unbox({})
+    else:
+        (name,exp) = result[key]
+        result[key] = (name,exp.unbox({}))
+
+
+def resolve_imp (result,env):
+    # resolve the identifiers of a parsed top-level form to lexical
+    # addresses, relative to the global environment env, once its
+    # variables that are never updated are unboxed
+
+    unbox_imp(result)
+    if result["result"] == "statement":
+        result["stmt"].resolve(env)
+    elif result["result"] == "declaration":
+        result["decl"][1].resolve(env)
+    elif result["result"] == "procedure":
+        result["proc"][1].resolve(env)
+    elif result["result"] == "template":
+        result["temp"][1].resolve(env)
+    elif result["result"] == "objectassignment":
+        result["assignment"][1].resolve(env)
+    return result
+
+
+def global_env_imp ():
+    # the initial global environment, with the root Object class
+    env = initial_env_imp()
+    env.define("Object",
+               VRefCell(VTemplate(
+                   False,"Object","Object",[[]],[],initial_env_imp())))
+    return env
+
+
+# Images
+#
+# A global environment, with everything defined in it (templates,
+# closures, objects and the expressions they run), can be saved to a
+# file and loaded back in place of global_env_imp(). Saved expressions
+# stay resolved. An image is marked with the interpreter's version, the
+# hash the parse cache uses (see interpreterVersion), and only loads in
+# the interpreter that saved it.
+# Images and cached forms (see below) are pickles, and loading a pickle
+# can run any code, so only files of the user's own, that nobody else
+# can write to, are loaded (see checkPrivate)
+
+IMAGE_MAGIC = "imp-image"
+
+
+def save_image_imp (env,path):
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit,100000))
+    try:
+        with open(path,"wb") as f:
+            cPickle.dump((IMAGE_MAGIC,interpreterVersion(),env),f,2)
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def checkPrivate (path,what):
+    # raise unless path belongs to the user running this and is writable
+    # by them alone
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        raise Exception("cannot use {} {}: {}".format(what,path,e.strerror))
+    if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise Exception("{} {} must belong to you and be writable by you alone".format(what,path))
+
+
+def load_image_imp (path):
+    checkPrivate(path,"image")
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit,100000))
+    try:
+        with open(path,"rb") as f:
+            image = cPickle.load(f)
+    except (cPickle.UnpicklingError,EOFError,AttributeError,ImportError,IndexError) as e:
+        raise Exception("{} is not an image: {}".format(path,e))
+    finally:
+        sys.setrecursionlimit(limit)
+    if type(image) is not tuple or len(image) != 3 or image[0] != IMAGE_MAGIC:
+        raise Exception("{} is not an image".format(path))
+    if image[1] != interpreterVersion():
+        raise Exception("{} is an image from another version of the interpreter".format(path))
+    return image[2]
+
+
+# Parse cache
+#
+# The forms of a script, as read_forms_imp yields them, can be kept in a
+# cache directory and loaded back instead of parsing the script again.
+# They are kept as parsed, before being optimized or resolved, since
+# resolving depends on the environment the script runs in. A file is
+# named after a hash of the script's text and of the interpreter's own
+# source, so editing either misses the cache; a file that cannot be
+# read back is parsed again. Once the files add up to more than the
+# size given, the least recently used ones are removed. The directory
+# is made writable by the user alone, and one that others can write to
+# is not used
+
+CACHE_MAGIC = "imp-forms"
+CACHE_SIZE = 64 * 1024 * 1024
+
+INTERPRETER_VERSION = None
+
+
+def interpreterVersion ():
+    # a hash of this module's source and of the Python running it
+    global INTERPRETER_VERSION
+    if INTERPRETER_VERSION is None:
+        with open(os.path.splitext(os.path.abspath(__file__))[0] + ".py","rb") as f:
+            INTERPRETER_VERSION = hashlib.sha1(sys.version + "\0" + f.read()).hexdigest()
+    return INTERPRETER_VERSION
+
+
+def cached_forms_imp (text,cache,size=CACHE_SIZE):
+    # the forms of the script text (see read_forms_imp), from the cache
+    # directory if they are there, parsed and saved there if not
+
+    if os.path.exists(cache):
+        checkPrivate(cache,"cache directory")
+    key = hashlib.sha1(interpreterVersion() + "\0" + text).hexdigest()
+    path = os.path.join(cache,key + ".forms")
+    forms = loadForms(path,key)
+    if forms is not None:
+        try:
+            # marks it as used (see trimCache)
+            os.utime(path,None)
+        except OSError:
+            pass
+        return forms
+    forms = list(read_forms_imp(text.splitlines(True)))
+    try:
+        saveForms(cache,path,key,forms)
+        trimCache(cache,size)
+    except (IOError,OSError):
+        # the cache is only there to save time
+        pass
+    return forms
+
+
+def loadForms (path,key):
+    # the forms saved at path under key, or None
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit,100000))
+    try:
+        with open(path,"rb") as f:
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                return None
+            saved = cPickle.load(f)
+    except Exception:
+        return None
+    finally:
+        sys.setrecursionlimit(limit)
+    if type(saved) is not tuple or len(saved) != 3 or saved[0] != CACHE_MAGIC or saved[1] != key:
+        return None
+    return saved[2]
+
+
+def saveForms (cache,path,key,forms):
+    # written to a file of its own first, so that whoever reads path
+    # never sees it half written
+    import tempfile
+    if not os.path.isdir(cache):
+        try:
+            os.makedirs(cache,0700)
+        except OSError:
+            if not os.path.isdir(cache):
+                raise
+    (fd,temp) = tempfile.mkstemp(suffix=".tmp",dir=cache)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit,100000))
+    try:
+        with os.fdopen(fd,"wb") as f:
+            cPickle.dump((CACHE_MAGIC,key,forms),f,2)
+        os.rename(temp,path)
+    except:
+        os.remove(temp)
+        raise
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def trimCache (cache,size):
+    # remove the least recently used files until the rest fit in size bytes
+    files = []
+    for name in os.listdir(cache):
+        if name.endswith(".forms"):
+            try:
+                st = os.stat(os.path.join(cache,name))
+            except OSError:
+                continue
+            files.append((st.st_mtime,st.st_size,name))
+    total = sum( n for (t,n,name) in files )
+    for (t,n,name) in sorted(files):
+        if total <= size:
+            break
+        try:
+            os.remove(os.path.join(cache,name))
+        except OSError:
+            pass
+        total -= n
+
+
+def engine_imp (name):
+    # the function used to evaluate expressions: "tree" walks the
+    # abstract representation, "closure" compiles it to Python closures
+    if name == "tree":
+        return lambda exp,env: exp.eval(env)
+    if name == "closure":
+        return lambda exp,env: exp.compile()(env)
+    raise Exception("Unknown engine {}".format(name))
+
+
+def exec_imp (result,env,run):
+    # Execute a resolved top-level form in the global environment env,
+    # evaluating expressions with run(exp,env)
+    # Returns the message to report, if any
+
+    if result["result"] == "statement":
+        stmt = result["stmt"]
+        # print "Abstract representation:", exp
+        v = run(stmt,env)
+
+    elif result["result"] == "declaration":
+        (name,expr) = result["decl"]
+        v = run(expr,env)
+        env.define(name,VRefCell(v))
+        return "{} defined".format(name)
+
+    elif result["result"] == "procedure":
+        (name,proc) = result["proc"]
+        v = run(proc,env)
+        env.define(name,VRefCell(v))
+        return "{} defined".format(name)
+
+    elif result["result"] == "template":
+        (name,temp) = result["temp"]
+        v = run(temp,env)
+        old = env.slots[env.slot(name)]
+        if old is not None and old.content.type == "template" and old.content not in v._ancestors:
+            # a new definition of a class: patch the template in place
+            kept = old.content.redefine(v)
+            return "\n".join(["{} redefined".format(old.content._fullname)] + kept)
+        env.define(name,VRefCell(v))
+        return "{} defined".format(v._fullname)
+
+    elif result["result"] == "objectassignment":
+        (name,ass) = result["assignment"]
+        v = run(ass,env)
+        env.define(name,VRefCell(v))
+        return "{} of type {} got assigned a {} object".format(name,v._template._fullname,v._object._class._fullname)
+
+    return None
+
+
+def profile_imp (arg,engine="tree"):
+    # #profile on, off and reset switch the counters on and off and clear
+    # them; #profile on its own reports them
+    if arg == "on":
+        if engine != "tree":
+            raise Exception("profiling needs the tree engine")
+        PROFILE_IMP.install()
+        return "profiling on"
+    if arg == "off":
+        PROFILE_IMP.uninstall()
+        return "profiling off"
+    if arg == "reset":
+        PROFILE_IMP.reset()
+        return "profile cleared"
+    return PROFILE_IMP.report()
+
+
+def census_command_imp (arg,root=None):
+    # #census shows the census as tables, #census json as JSON
+    census = census_imp(root)
+    return census_dump(census) if arg == "json" else census_report(census)
+
+
+def bracket_depth (text,depth=0):
+    # how many brackets are left open at the end of text, outside strings
+    quote = None
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if quote is not None:
+            if c == "\\":
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c == "\"" or c == "'":
+            quote = c
+        elif c in "({[":
+            depth += 1
+        elif c in ")}]":
+            depth -= 1
+        i += 1
+    return depth
+
+
+def read_forms_imp (lines):
+    # Split source text into top-level forms, yielding each one as soon as
+    # it is complete, so only the form being read is kept in memory.
+    # Yields (line number, parse result, None), or (line number, None,
+    # error) for a syntax error.
+    # Lines are added to the form until it parses; a form that is
+    # complete but could still take an else on the next line is held back
+    # until that line is seen. #multi and #end lines are ignored.
+
+    grammar = formGrammar()
+    buffer = ""
+    start = 0
+    depth = 0
+    pending = None
+
+    for (lineno,line) in enumerate(lines,1):
+        if pending is not None and line.strip() != "":
+            if not re.match(r"\s*else\b",line):
+                yield pending
+                buffer = ""
+            pending = None
+
+        if buffer.strip() == "":
+            if line.strip() in ("","#multi","#end"):
+                continue
+            buffer = ""
+            start = lineno
+            depth = 0
+
+        buffer += line
+        depth = bracket_depth(line,depth)
+        if depth > 0:
+            continue
+
+        while buffer.strip() != "":
+            try:
+                result = grammar.parseString(buffer)
+            except ParseException as e:
+                if e.loc >= len(buffer.rstrip()) and depth == 0:
+                    # ran out of text: the form goes on on the next line
+                    break
+                yield (start + buffer[:e.loc].count("\n"),None,
+                       Exception("Syntax error at line {}, column {}".format(start + buffer[:e.loc].count("\n"),e.col)))
+                buffer = ""
+                break
+            (form,rest) = (result[0],result[-1])
+            if re.match(r"\s*else\b",rest):
+                # the else branch is still to come
+                break
+            if rest.strip() == "" and re.match(r"\s*if\b",buffer):
+                pending = (start,form,None)
+                break
+            yield (start,form,None)
+            start += buffer[:len(buffer)-len(rest)].count("\n")
+            buffer = rest
+            depth = bracket_depth(rest)
+
+    if pending is not None:
+        yield pending
+    elif buffer.strip() != "":
+        yield (start,None,Exception("Syntax error at line {}: unexpected end of input".format(start)))
+
+
+#
+# Stopping an evaluation
+#
+# Runtime errors are plain Exceptions, and the interpreter catches them
+# where it can carry on without what failed. An Interrupt stops the
+# evaluation that raised it, and is never caught on the way out: the
+# server's time and output limits are Interrupts.
+# Another thread can ask the evaluation running in a thread to stop
+# (see stop_imp). The engines look for such a request at safe points,
+# at each call and each round of a loop, where raising leaves nothing
+# half done; STOPS is empty unless some thread has one to take
+#
+
+class Interrupt (Exception):
+    pass
+
+
+# thread ident -> the Interrupt (class) it is to raise
+STOPS = {}
+
+
+def stop_imp (ident,exception):
+    # have the thread ident raise exception at its next safe point, or
+    # with None, drop the request if it has not been taken yet
+    if exception is None:
+        STOPS.pop(ident,None)
+    else:
+        STOPS[ident] = exception
+
+
+def stopped ():
+    # at a safe point: raise the Interrupt this thread is asked to, if any
+    exception = STOPS.pop(get_ident(),None)
+    if exception is not None:
+        raise exception()
+
+
+#
+# Deep recursion
+#
+# A call in the language that is not in tail position nests a few Python
+# calls, whichever engine runs it, so the main thread's stack and
+# Python's default recursion limit only allow recursion a few hundred
+# calls deep. Scripts, the shell and the server's sessions run in
+# threads with a stack of STACK_SIZE bytes instead, under a recursion
+# limit that such a stack can hold: a Python frame takes well under a
+# kilobyte of it. Recursion beyond that is a runtime error, as before
+#
+
+STACK_SIZE = 512 * 1024 * 1024
+RECURSION_LIMIT = STACK_SIZE // 1024
+
+
+def deep_thread_imp (target,args=()):
+    # start a daemon thread running target(*args), with a stack deep
+    # enough for RECURSION_LIMIT frames (the size applies to the threads
+    # started while it is set)
+    if sys.getrecursionlimit() < RECURSION_LIMIT:
+        sys.setrecursionlimit(RECURSION_LIMIT)
+    thread = threading.Thread(target=target,args=args)
+    thread.daemon = True
+    size = threading.stack_size(STACK_SIZE)
+    try:
+        thread.start()
+    finally:
+        threading.stack_size(size)
+    return thread
+
+
+def deep_imp (f,*args,**kwargs):
+    # f(*args,**kwargs), run in a deep thread (see deep_thread_imp)
+    result = []
+    def run ():
+        try:
+            result.append((True,f(*args,**kwargs)))
+        except BaseException:
+            result.append((False,sys.exc_info()))
+    thread = deep_thread_imp(run)
+    # with a timeout, so that the main thread still sees Ctrl-C
+    while thread.is_alive():
+        thread.join(60)
+    (done,value) = result[0]
+    if not done:
+        raise value[0],value[1],value[2]
+    return value
+
+
+def batch_imp (lines,quiet=False,engine="tree",keepGoing=False,optimize=False,env=None,
+               cache=None,cacheSize=CACHE_SIZE):
+    # Run a script non-interactively, evaluating each top-level form as
+    # soon as it has been read, in env (by default a new global
+    # environment). Stops at the first error unless keepGoing.
+    # With optimize, forms go through optimize_imp first, and the number
+    # of nodes eliminated and of constants folded is reported at the end.
+    # With a cache directory, the whole script is read first and its
+    # forms are looked up there (see cached_forms_imp).
+    # Returns the exit status: 0 if every form ran, 1 otherwise
+
+    run = engine_imp(engine)
+    if env is None:
+        env = global_env_imp()
+    status = 0
+    (eliminated,folded) = (0,0)
+    if cache is not None:
+        forms = cached_forms_imp("".join(lines),cache,cacheSize)
+    else:
+        forms = read_forms_imp(lines)
+
+    for (lineno,result,error) in forms:
+        if error is None:
+            try:
+                if optimize:
+                    (n,k) = optimize_imp(result)
+                    (eliminated,folded) = (eliminated + n,folded + k)
+                resolve_imp(result,env)
+                if result["result"] == "quit":
+                    break
+                elif result["result"] == "abstract":
+                    print result["stmt"]
+                elif result["result"] == "profile":
+                    print profile_imp(result["arg"],engine)
+                elif result["result"] == "census":
+                    print census_command_imp(result["arg"])
+                elif result["result"] != "multi":
+                    message = exec_imp(result,env,run)
+                    if message is not None and not quiet:
+                        print message
+            except Exception as e:
+                error = e
+        if error is not None:
+            sys.stdout.flush()
+            sys.stderr.write("line {}: Exception: {}\n".format(lineno,error))
+            status = 1
+            if not keepGoing:
+                break
+
+    sys.stdout.flush()
+    if optimize and not quiet:
+        sys.stderr.write(optimizerReport(eliminated,folded) + "\n")
+    return status
+
+
+def run_program_imp (job):
+    # Run the script at path in batch mode, in a new global environment
+    # (or the one saved in image), with its output captured
+    # Returns (path, exit status, output, error output, seconds)
+
+    (path,engine,optimize,image,cache,cacheSize,quiet,keepGoing) = job
+    import StringIO
+    (out,err) = (StringIO.StringIO(),StringIO.StringIO())
+    saved = (sys.stdout,sys.stderr)
+    (sys.stdout,sys.stderr) = (out,err)
+    start = time.time()
+    try:
+        try:
+            env = load_image_imp(image) if image else None
+            with open(path) as lines:
+                status = deep_imp(batch_imp,lines,quiet=quiet,engine=engine,keepGoing=keepGoing,
+                                  optimize=optimize,env=env,cache=cache,cacheSize=cacheSize)
+        except Exception as e:
+            err.write("{}\n".format(e))
+            status = 2
+    finally:
+        (sys.stdout,sys.stderr) = saved
+    return (path,status,out.getvalue(),err.getvalue(),time.time() - start)
+
+
+def pool_imp (paths,engine="tree",optimize=False,image=None,processes=None,ordered=True,
+              cache=None,cacheSize=CACHE_SIZE,quiet=False,keepGoing=False,packrat=False):
+    # Run many scripts, each in its own environment, across a pool of
+    # worker processes (one per core by default), yielding the result of
+    # each (see run_program_imp) in the order of paths, or as soon as it
+    # is done if not ordered. The other options are as for batch_imp, and
+    # packrat turns on packrat parsing in the worker processes
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes,packrat_imp if packrat else None)
+    try:
+        jobs = [ (path,engine,optimize,image,cache,cacheSize,quiet,keepGoing) for path in paths ]
+        results = (pool.imap if ordered else pool.imap_unordered)(run_program_imp,jobs,1)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def shell_imp (engine="tree",optimize=False,env=None):
     # A simple shell
     # Repeatedly read a line of input, parse it, and evaluate the result
 
+    run = engine_imp(engine)
+
     print "Inheritance and Polymorphism"
     print "#quit to quit, #abs to see abstract representation"
-    env = initial_env_imp()
-    env.insert(0,
-                ("Object",
-                VRefCell(VTemplate(
-                    False,"Object","Object",[[]],[],initial_env_imp()))))
+    print "#profile on to count evaluations, #profile to see the counts"
+    print "#census to see what is taking up memory"
+    if env is None:
+        env = global_env_imp()
     multi = False
 
         
@@ -977,42 +3508,26 @@ def shell_imp ():
         multi = False
 
         try:
-            result = parse_imp(inp) 
-
-            if result["result"] == "statement":
-                stmt = result["stmt"]
-                # print "Abstract representation:", exp
-                v = stmt.eval(env)
-
-            elif result["result"] == "abstract":
+            result = parse_imp(inp)
+            if optimize:
+                (eliminated,folded) = optimize_imp(result)
+                if eliminated or folded:
+                    print optimizerReport(eliminated,folded)
+            resolve_imp(result,env)
+
+            if result["result"] == "abstract":
                 print result["stmt"]
 
             elif result["result"] == "quit":
+                if PROFILE_IMP.installed():
+                    print PROFILE_IMP.report()
                 return
 
-            elif result["result"] == "declaration":
-                (name,expr) = result["decl"]
-                v = expr.eval(env)
-                env.insert(0,(name,VRefCell(v)))
-                print "{} defined".format(name)
-
-            elif result["result"] == "procedure":
-                (name,proc) = result["proc"]
-                v = proc.eval(env)
-                env.insert(0,(name,VRefCell(v)))
-                print "{} defined".format(name)
-
-            elif result["result"] == "template":
-                (name,temp) = result["temp"]
-                v = temp.eval(env)
-                env.insert(0,(name,VRefCell(v)))
-                print "{} defined".format(v._fullname)
-
-            elif result["result"] == "objectassignment":
-                (name,ass) = result["assignment"]
-                v = ass.eval(env)
-                env.insert(0,(name,VRefCell(v)))
-                print "{} of type {} got assigned a {} object".format(name,v._template._fullname,v._object._class._fullname)
+            elif result["result"] == "profile":
+                print profile_imp(result["arg"],engine)
+
+            elif result["result"] == "census":
+                print census_command_imp(result["arg"])
 
             elif result["result"] == "multi":
                 multi = True
@@ -1021,7 +3536,141 @@ def shell_imp ():
                 while(not (nextLine == "#end")):
                     inp += nextLine
                     nextLine = raw_input("| ")
+
+            else:
+                message = exec_imp(result,env,run)
+                if message is not None:
+                    print message
                 
-                
         except Exception as e:
-            print "Exception: {}".format(e)
\ No newline at end of file
+            print "Exception: {}".format(e)
+
+
+def main_imp (argv):
+    # Command line entry point: run a script, or stdin, in batch mode, or
+    # start the shell when there is no script and stdin is a terminal
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Inheritance and Polymorphism interpreter")
+    parser.add_argument("files",nargs="*",metavar="file",help="script to run, or - for stdin")
+    parser.add_argument("-q","--quiet",action="store_true",help="do not report declarations")
+    parser.add_argument("-k","--keep-going",action="store_true",help="keep running after an error")
+    parser.add_argument("-e","--engine",choices=["tree","closure"],default="tree",
+                        help="tree walker or compiled closures (faster)")
+    parser.add_argument("--packrat",action="store_true",help="use packrat parsing")
+    parser.add_argument("-O","--optimize",action="store_true",
+                        help="fold constants and simplify forms before running them")
+    parser.add_argument("--profile",action="store_true",
+                        help="count and time evaluations, and report them at exit")
+    parser.add_argument("--numpy",action="store_true",
+                        help="store integer arrays in NumPy arrays")
+    parser.add_argument("--census",metavar="FILE",
+                        help="write the census as JSON to this file at the end, or every --census-every seconds")
+    parser.add_argument("--census-every",type=float,metavar="SECONDS")
+    parser.add_argument("-j","--jobs",type=int,
+                        help="run the scripts in parallel in this many processes (0 for one per core)")
+    parser.add_argument("--unordered",action="store_true",
+                        help="with -j, report each script as soon as it is done")
+    parser.add_argument("--image",help="start from the global environment saved in this image")
+    parser.add_argument("--save-image",metavar="IMAGE",
+                        help="save the global environment to this image at the end")
+    parser.add_argument("--cache",metavar="DIR",
+                        help="keep the parsed scripts in this directory, and reuse them")
+    parser.add_argument("--cache-size",type=float,default=CACHE_SIZE / (1024 * 1024),metavar="MB",
+                        help="how big the cache directory can get")
+    args = parser.parse_args(argv[1:])
+
+    if args.numpy:
+        try:
+            numpy_imp()
+        except ImportError:
+            parser.error("--numpy needs NumPy installed")
+
+    if args.profile:
+        if args.engine != "tree":
+            parser.error("--profile needs the tree engine")
+        if args.jobs is not None or len(args.files) > 1:
+            parser.error("--profile runs one script at a time")
+        PROFILE_IMP.install()
+
+    if args.census_every and not args.census:
+        parser.error("--census-every needs --census")
+
+    cacheSize = int(args.cache_size * 1024 * 1024)
+    if args.cache and os.path.exists(args.cache):
+        try:
+            checkPrivate(args.cache,"cache directory")
+        except Exception as e:
+            sys.stderr.write("{}\n".format(e))
+            return 2
+
+    if args.jobs is not None or len(args.files) > 1:
+        if "-" in args.files or args.save_image or args.census:
+            parser.error("scripts run in parallel must be files, and cannot save an image or a census")
+        status = 0
+        start = time.time()
+        for (path,code,output,errors,seconds) in pool_imp(args.files,args.engine,args.optimize,args.image,
+                                                          args.jobs or None,not args.unordered,
+                                                          args.cache,cacheSize,args.quiet,
+                                                          args.keep_going,args.packrat):
+            print "==> {} (status {}, {:.3f}s)".format(path,code,seconds)
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            sys.stderr.write(errors)
+            status = max(status,code)
+        sys.stderr.write("{} scripts in {:.3f}s\n".format(len(args.files),time.time() - start))
+        return status
+
+    env = None
+    if args.image:
+        try:
+            env = load_image_imp(args.image)
+        except (Exception,IOError) as e:
+            sys.stderr.write("{}\n".format(e))
+            return 2
+
+    if args.census_every:
+        sample_census_imp(args.census,args.census_every)
+
+    if args.packrat:
+        packrat_imp()
+
+    path = args.files[0] if args.files else None
+    if path is None and sys.stdin.isatty():
+        if env is None:
+            env = global_env_imp()
+        deep_imp(shell_imp,engine=args.engine,optimize=args.optimize,env=env)
+        if args.save_image:
+            save_image_imp(env,args.save_image)
+        if args.census:
+            with open(args.census,"a") as f:
+                f.write(census_dump(census_imp()) + "\n")
+        return 0
+
+    if path is None or path == "-":
+        lines = iter(sys.stdin.readline,"")
+    else:
+        try:
+            lines = open(path)
+        except IOError as e:
+            sys.stderr.write("{}\n".format(e))
+            return 2
+    if env is None:
+        env = global_env_imp()
+    status = deep_imp(batch_imp,lines,quiet=args.quiet,engine=args.engine,keepGoing=args.keep_going,
+                      optimize=args.optimize,env=env,cache=args.cache,cacheSize=cacheSize)
+    if args.save_image:
+        save_image_imp(env,args.save_image)
+    if args.profile:
+        sys.stderr.write(PROFILE_IMP.report())
+    if args.census:
+        with open(args.census,"a") as f:
+            f.write(census_dump(census_imp()) + "\n")
+    return status
+
+
+if __name__ == "__main__":
+    # go through the module proper, so that images and cached forms name
+    # the classes final.*, as they are when loaded elsewhere
+    import final
+    sys.exit(final.main_imp(sys.argv))
@@ -0,0 +1,386 @@
+############################################################
+# Network server
+#
+# Serves the shell over TCP or a Unix socket. Each connection is a
+# session with its own global environment (and Object template), made
+# when it sends its first form, so that an idle session costs little
+# more than its socket.
+#
+# Connections are handled by a single asyncore loop. Complete forms are
+# parsed and evaluated by a pool of worker threads, so a slow program
+# does not hold up the other sessions, and while a session's forms are
+# being evaluated the server reads nothing more from it.
+#
+# A session sends lines, as typed at the shell: a form is evaluated
+# once its brackets are closed, or at #end after #multi. What it prints
+# is sent back, followed by the "imp> " prompt. #quit closes the session.
+#
+# Limits, per session: the size of a form, the output of the forms
+# evaluated together, the time they take (the evaluation is stopped at
+# its next call or round of a loop) and how long the session can stay
+# idle; and the number of sessions at once.
+#
+# Usage: python server.py [--port 7777 | --unix PATH] [-e tree|closure]
+#                         [--workers 4] [--max-sessions 1000] [--time-limit 10]
+#                         [--output-limit 1000000] [--input-limit 65536]
+#                         [--idle-timeout 600]
+#
+
+import asynchat
+import asyncore
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+
+from final import *
+
+
+class TimeLimit (Interrupt):
+    # raised in a worker thread when its forms have run for too long
+
+    def __init__ (self):
+        Exception.__init__(self,"time limit exceeded")
+
+
+class OutputLimit (Interrupt):
+    pass
+
+
+class Capture (object):
+    # what the forms of one evaluation print, up to limit bytes
+
+    def __init__ (self,limit):
+        self.chunks = []
+        self.size = 0
+        self.limit = limit
+
+    def write (self,text):
+        self.size += len(text)
+        if self.size > self.limit:
+            raise OutputLimit("output limit of {} bytes exceeded".format(self.limit))
+        self.chunks.append(text)
+
+    def note (self,text):
+        # a message from the server, outside the limit
+        self.chunks.append(text)
+
+    def flush (self):
+        pass
+
+    def getvalue (self):
+        return "".join(self.chunks)
+
+
+class ThreadOutput (object):
+    # sys.stdout while serving: what a worker thread prints goes to the
+    # capture of the evaluation it is running, everything else to stdout
+
+    def __init__ (self,stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write (self,text):
+        (getattr(self.local,"capture",None) or self.stdout).write(text)
+
+    def flush (self):
+        (getattr(self.local,"capture",None) or self.stdout).flush()
+
+
+#
+# Sessions
+#
+
+class Session (asynchat.async_chat):
+
+    def __init__ (self,sock,server):
+        asynchat.async_chat.__init__(self,sock)
+        self.set_terminator("\n")
+        self.server = server
+        self.env = None
+        self.incoming = []
+        self.size = 0
+        self.lines = []
+        self.depth = 0
+        self.multi = False
+        # lines read while forms are being evaluated, to go through next
+        self.waiting = []
+        # the worker thread running this session's forms, and its deadline
+        self.running = None
+        self.deadline = None
+        self.active = time.time()
+        self.push("Inheritance and Polymorphism\n#quit to quit\nimp> ")
+
+    def readable (self):
+        return self.running is None and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data (self,data):
+        self.size += len(data)
+        if self.size > self.server.inputLimit:
+            self.push("Exception: input limit of {} bytes exceeded\n".format(self.server.inputLimit))
+            self.close_when_done()
+            return
+        self.incoming.append(data)
+
+    def found_terminator (self):
+        line = "".join(self.incoming).rstrip("\r") + "\n"
+        self.incoming = []
+        self.active = time.time()
+        if self.running is not None:
+            self.waiting.append(line)
+        else:
+            self.received(line)
+
+    def received (self,line):
+        if not self.connected:
+            return
+        if line.strip() == "#quit" and not self.lines:
+            self.close_when_done()
+            return
+        if self.multi:
+            if line.strip() == "#end":
+                self.multi = False
+            else:
+                self.lines.append(line)
+        elif line.strip() == "#multi":
+            self.multi = True
+        else:
+            self.lines.append(line)
+            self.depth = bracket_depth(line,self.depth)
+        if self.multi or self.depth > 0:
+            return
+        lines = self.lines
+        (self.lines,self.depth,self.size) = ([],0,0)
+        if "".join(lines).strip() == "":
+            self.push("imp> ")
+            return
+        self.running = True
+        self.server.work.put((self,lines))
+
+    def finished (self,output,quit):
+        # called in the loop when a worker is done with this session's forms
+        self.running = None
+        self.deadline = None
+        self.active = time.time()
+        if not self.connected:
+            return
+        self.push(output)
+        if quit:
+            self.close_when_done()
+            return
+        self.push("imp> ")
+        while self.waiting and self.running is None:
+            self.received(self.waiting.pop(0))
+
+    def handle_close (self):
+        self.close()
+
+    def close (self):
+        asynchat.async_chat.close(self)
+        self.server.sessions.discard(self)
+
+
+#
+# Evaluation, in the worker threads
+#
+
+def evaluate (session,lines,server):
+    # parse and evaluate the forms in lines in the session's environment
+    # Returns what they print, and whether the session asked to quit
+
+    capture = Capture(server.outputLimit)
+    server.output.local.capture = capture
+    quit = False
+    try:
+        if session.env is None:
+            session.env = global_env_imp()
+        env = session.env
+        forms = list(read_forms_imp(lines))
+        for (lineno,result,error) in forms:
+            if error is None:
+                try:
+                    resolve_imp(result,env)
+                    if result["result"] == "quit":
+                        quit = True
+                        break
+                    elif result["result"] == "abstract":
+                        print result["stmt"]
+                    elif result["result"] == "profile":
+                        raise Exception("profiling is not available here")
+                    elif result["result"] == "census":
+                        # only what this session's environment leads to
+                        print census_command_imp(result["arg"],env)
+                    elif result["result"] != "multi":
+                        message = exec_imp(result,env,server.run)
+                        if message is not None:
+                            print message
+                except Interrupt as e:
+                    capture.note("Exception: {}\n".format(e))
+                    break
+                except Exception as e:
+                    error = e
+            if error is not None:
+                capture.note("Exception: {}\n".format(error))
+    finally:
+        server.output.local.capture = None
+    return (capture.getvalue(),quit)
+
+
+def worker (server):
+    ident = threading.current_thread().ident
+    while True:
+        (session,lines) = server.work.get()
+        try:
+            try:
+                with server.lock:
+                    session.running = ident
+                    session.deadline = time.time() + server.timeLimit if server.timeLimit else None
+                result = evaluate(session,lines,server)
+            finally:
+                # police() only stops a session with a deadline, so once
+                # this is done the thread cannot be stopped any more
+                with server.lock:
+                    session.deadline = None
+                    stop_imp(ident,None)
+        except Exception as e:
+            result = ("Exception: {}\n".format(e),False)
+        server.done.put((session,result))
+        server.waker.wake()
+
+
+class Waker (asyncore.file_dispatcher):
+    # wakes the loop up when a worker has finished
+
+    def __init__ (self,server):
+        (self.r,self.w) = os.pipe()
+        asyncore.file_dispatcher.__init__(self,self.r)
+        self.server = server
+
+    def writable (self):
+        return False
+
+    def wake (self):
+        os.write(self.w,"x")
+
+    def handle_read (self):
+        self.recv(4096)
+        while True:
+            try:
+                (session,(output,quit)) = self.server.done.get_nowait()
+            except Queue.Empty:
+                return
+            session.finished(output,quit)
+
+
+#
+# The server
+#
+
+class Server (asyncore.dispatcher):
+
+    def __init__ (self,address,family=socket.AF_INET,engine="tree",workers=4,
+                  maxSessions=1000,timeLimit=10,outputLimit=1000000,inputLimit=65536,
+                  idleTimeout=600):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(family,socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.set_reuse_addr()
+        elif os.path.exists(address):
+            os.unlink(address)
+        self.bind(address)
+        self.listen(128)
+        self.address = self.socket.getsockname()
+
+        self.run = engine_imp(engine)
+        self.maxSessions = maxSessions
+        self.timeLimit = timeLimit
+        self.outputLimit = outputLimit
+        self.inputLimit = inputLimit
+        self.idleTimeout = idleTimeout
+        self.sessions = set()
+
+        self.work = Queue.Queue()
+        self.done = Queue.Queue()
+        self.lock = threading.Lock()
+        self.output = ThreadOutput(sys.stdout)
+        self.waker = Waker(self)
+        # deep threads, so that sessions can recurse as deep as scripts
+        self.workers = [ deep_thread_imp(worker,(self,)) for i in range(workers) ]
+
+    def handle_accept (self):
+        pair = self.accept()
+        if pair is None:
+            return
+        (sock,addr) = pair
+        if len(self.sessions) >= self.maxSessions:
+            sock.sendall("Exception: too many sessions\n")
+            sock.close()
+            return
+        self.sessions.add(Session(sock,self))
+
+    def police (self):
+        # stop evaluations that are over time, and close idle sessions
+        now = time.time()
+        with self.lock:
+            for session in list(self.sessions):
+                if session.deadline is not None and now > session.deadline:
+                    session.deadline = None
+                    stop_imp(session.running,TimeLimit)
+        if self.idleTimeout:
+            for session in list(self.sessions):
+                if session.running is None and now - session.active > self.idleTimeout:
+                    session.push("Exception: idle for too long\n")
+                    session.close_when_done()
+                    self.sessions.discard(session)
+
+    def serve (self):
+        saved = sys.stdout
+        sys.stdout = self.output
+        try:
+            while True:
+                asyncore.loop(timeout=0.25,use_poll=True,count=1)
+                self.police()
+        finally:
+            sys.stdout = saved
+
+
+
+def main (argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve the interpreter over the network")
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument("--port",type=int,default=7777,help="TCP port on localhost")
+    where.add_argument("--unix",help="path of a Unix socket to listen on instead")
+    parser.add_argument("--host",default="127.0.0.1")
+    parser.add_argument("-e","--engine",choices=["tree","closure"],default="tree",
+                        help="tree walker or compiled closures (faster)")
+    parser.add_argument("--workers",type=int,default=4,help="threads evaluating forms")
+    parser.add_argument("--max-sessions",type=int,default=1000)
+    parser.add_argument("--time-limit",type=float,default=10,
+                        help="seconds forms can run for (0 for no limit)")
+    parser.add_argument("--output-limit",type=int,default=1000000,
+                        help="bytes forms evaluated together can print")
+    parser.add_argument("--input-limit",type=int,default=65536,help="bytes in a form")
+    parser.add_argument("--idle-timeout",type=float,default=600,
+                        help="seconds before an idle session is closed (0 for never)")
+    args = parser.parse_args(argv[1:])
+
+    if args.unix:
+        (address,family) = (args.unix,socket.AF_UNIX)
+    else:
+        (address,family) = ((args.host,args.port),socket.AF_INET)
+    server = Server(address,family,engine=args.engine,workers=args.workers,
+                    maxSessions=args.max_sessions,timeLimit=args.time_limit,
+                    outputLimit=args.output_limit,inputLimit=args.input_limit,
+                    idleTimeout=args.idle_timeout)
+    sys.stderr.write("serving on {}\n".format(server.address))
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))